@@ -0,0 +1,336 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Times the hot paths of sonnet.py with fixed seeds and saves the
+# results as JSON, so runs can be compared across commits.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sonnet as snt
+import argparse
+import sys
+import json
+import time
+import random
+import logging
+import resource
+import subprocess
+from timeit import default_timer as timer
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the sonnet generation pipeline.")
+    parser.add_argument("--output",
+                        "-o",
+                        default="benchmark.json",
+                        help="Results filename (Default: benchmark.json)")
+    parser.add_argument("--seed",
+                        "-s",
+                        type=int,
+                        default=0,
+                        help="Random seed (Default: 0)")
+    parser.add_argument("--rounds",
+                        "-r",
+                        type=int,
+                        default=200,
+                        help="Timed calls per micro benchmark (Default: 200)")
+    parser.add_argument("--poems",
+                        "-p",
+                        type=int,
+                        default=5,
+                        help="Poems written per end-to-end benchmark (Default: 5)")
+    parser.add_argument("--only",
+                        nargs="+",
+                        default=None,
+                        help="Only run the named benchmarks")
+    parser.add_argument("--compare",
+                        "-c",
+                        default=None,
+                        help="Earlier results file to compare against")
+    parsed_args = parser.parse_args(args)
+    return vars(parsed_args)
+
+
+def percentile(ordered, fraction):
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(durations):
+    ordered = sorted(durations)
+    ms = 1000.0
+    return {"calls": len(ordered),
+            "total": sum(ordered),
+            "mean_ms": sum(ordered) / len(ordered) * ms,
+            "min_ms": ordered[0] * ms,
+            "p50_ms": percentile(ordered, 0.5) * ms,
+            "p90_ms": percentile(ordered, 0.9) * ms,
+            "p99_ms": percentile(ordered, 0.99) * ms,
+            "max_ms": ordered[-1] * ms}
+
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def proc_memory(field):
+    """A figure in kB from /proc/self/status ("VmRSS", "VmHWM"), or None off Linux."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """Starts the peak resident size (VmHWM) again from the current one,
+    so it covers only what runs next. Returns False where that's not possible."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        return False
+    return proc_memory("VmHWM") is not None
+
+
+def time_calls(func, args_list):
+    durations = []
+    for args in args_list:
+        start = timer()
+        func(*args)
+        durations.append(timer() - start)
+    return durations
+
+
+def sample_words(vocab, rng, rounds):
+    words = []
+    for tag in ["NN", "NNS", "VB", "JJ"]:
+        words.extend((word, tag) for word in vocab.common_words(tag))
+    return [rng.choice(words) for _ in xrange(rounds)]
+
+
+def bench_word(context):
+    words = [word for word, _ in context["words"]]
+    # A cold cache measures the analysis, not the lookup
+    snt.word_cache.clear()
+    cold = time_calls(snt.Word, [(word,) for word in words])
+    warm = time_calls(snt.Word, [(word,) for word in words])
+    return {"cold": summarize(cold), "warm": summarize(warm)}
+
+
+def bench_scans(context):
+    # Randomly filled lines, most of which don't scan, like the rejection sampler sees
+    lines = []
+    for _ in xrange(context["rounds"]):
+        template = context["rng"].choice(context["templates"])
+        template.make_pools(context["vocab"])
+        lines.append(template.populate(context["rng"]))
+    return summarize(time_calls(lambda line: line.scans(), [(line,) for line in lines]))
+
+
+def bench_scanning_line(context):
+    rng = context["rng"]
+    durations, failures = [], 0
+    for _ in xrange(context["rounds"]):
+        template = rng.choice(context["templates"])
+        template.make_pools(context["vocab"])
+        start = timer()
+        try:
+            template.make_scanning_line(rng=rng)
+        except snt.ScanFailure:
+            failures += 1
+        durations.append(timer() - start)
+    result = summarize(durations)
+    result["failures"] = failures
+    return result
+
+
+def bench_rhyming_words(context):
+    vocab = context["vocab"]
+    words = [(snt.Word(word), tag) for word, tag in context["words"]]
+    vocab.rhyme_index = {}
+    # The first call per tag builds that tag's rhyme classes
+    cold = time_calls(vocab.rhyming_words, words[:1])
+    warm = time_calls(vocab.rhyming_words, words)
+    return {"first": summarize(cold), "warm": summarize(warm)}
+
+
+def rhyme_ready_pairs(context, number):
+    pairs = []
+    writer = context["writer"]
+    templates = context["templates"]
+    for _ in xrange(number * 20):
+        template_pair = context["rng"].sample(templates, 2)
+        try:
+            writer.force_rhyme_cands(template_pair)
+        except (snt.PairFailure, snt.ScanFailure):
+            continue
+        if template_pair[0].candidates and template_pair[1].candidates:
+            pairs.append((list(template_pair[0].candidates), list(template_pair[1].candidates)))
+        for template in template_pair:
+            template.cleanup()
+        if len(pairs) >= number:
+            break
+    return pairs
+
+
+def bench_select_rhymes(context):
+    writer = context["writer"]
+    pair = [snt.Template("", []), snt.Template("", [])]
+
+    def select(candidates1, candidates2):
+        pair[0].candidates, pair[1].candidates = candidates1, candidates2
+        writer.select_rhyming_candidates(pair)
+
+    pairs = rhyme_ready_pairs(context, 10)
+    if not pairs:
+        return None
+    rounds = max(1, context["rounds"] // 10)
+    return summarize(time_calls(select, [pairs[index % len(pairs)] for index in xrange(rounds)]))
+
+
+def bench_new_poem(context, make_poem):
+    writer = context["writer"]
+    durations = []
+    writer.vocab.clear_collections()
+    for index in xrange(context["poems"]):
+        writer.seed(context["seed"] + index)
+        writer.vocab.add_random_collections()
+        start = timer()
+        writer.new_poem(make_poem())
+        durations.append(timer() - start)
+        writer.vocab.clear_collections()
+    return summarize(durations)
+
+
+def bench_reservoir(context):
+    # Couplets written back to back, reusing candidates between poems
+    writer = context["writer"]
+    writer.reservoir = snt.CandidateReservoir()
+    try:
+        result = bench_new_poem(context, lambda: snt.HeroicCouplets(7))
+        result["reservoir"] = writer.reservoir.stats()
+    finally:
+        writer.reservoir = None
+    return result
+
+
+benchmarks = [("word", bench_word),
+              ("line_scans", bench_scans),
+              ("make_scanning_line", bench_scanning_line),
+              ("rhyming_words", bench_rhyming_words),
+              ("select_rhyming_candidates", bench_select_rhymes),
+              ("new_poem_sonnet", lambda context: bench_new_poem(context, snt.Sonnet)),
+              ("new_poem_couplets", lambda context: bench_new_poem(context, lambda: snt.HeroicCouplets(7))),
+              ("new_poem_couplets_reservoir", bench_reservoir)]
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timings(results):
+    """Yields (label, stats) for every set of timings, naming the
+    phases of benchmarks that have more than one."""
+    for name, result in sorted(results.items()):
+        if not result:
+            continue
+        if "p50_ms" in result:
+            yield name, result
+        else:
+            for phase, stats in sorted(result.items()):
+                if isinstance(stats, dict):
+                    yield "{}.{}".format(name, phase), stats
+
+
+def compare(results, filename):
+    with open(filename, "r") as f:
+        previous = dict(timings(json.load(f)["benchmarks"]))
+    for label, stats in timings(results):
+        old_stats = previous.get(label)
+        if old_stats:
+            print "{:<36} p50 {:>10.3f} ms -> {:>10.3f} ms  ({:.2f}x)".format(
+                label, old_stats["p50_ms"], stats["p50_ms"], old_stats["p50_ms"] / max(stats["p50_ms"], 1e-9))
+
+
+def main(args):
+    start_memory = peak_memory()
+    vocab = snt.Vocab.from_snapshot(seed=args["seed"])
+    writer = snt.SonnetWriter(vocab)
+    writer.load_templates("line_templates.csv")
+    vocab.add_random_collections()
+    context = {"vocab": vocab,
+               "writer": writer,
+               "templates": writer.template_pool,
+               "rng": random.Random(args["seed"]),
+               "seed": args["seed"],
+               "rounds": args["rounds"],
+               "poems": args["poems"]}
+    context["words"] = sample_words(vocab, context["rng"], args["rounds"])
+
+    results = {}
+    for name, bench in benchmarks:
+        if args["only"] and name not in args["only"]:
+            continue
+        logging.info("Running {}...".format(name))
+        # Every benchmark starts from the same random state
+        context["rng"].seed(args["seed"])
+        writer.seed(args["seed"])
+        reset = reset_peak_memory()
+        start_rss = proc_memory("VmRSS")
+        result = bench(context)
+        if result is not None:
+            if reset:
+                result["peak_memory_kb"] = proc_memory("VmHWM")
+                result["memory_growth_kb"] = result["peak_memory_kb"] - start_rss
+            else:
+                # ru_maxrss never goes down, so this is the peak of everything run so far
+                result["process_peak_memory_kb"] = peak_memory()
+        results[name] = result
+        writer.current_poem = None
+        vocab.clear_used()
+        for template in writer.template_pool:
+            template.cleanup()
+
+    report = {"commit": commit_id(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "seed": args["seed"],
+              "rounds": args["rounds"],
+              "poems": args["poems"],
+              "start_memory_kb": start_memory,
+              "peak_memory_kb": peak_memory(),
+              "word_cache": snt.word_cache.stats(),
+              "benchmarks": results}
+    with open(args["output"], "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for label, stats in timings(results):
+        print "{:<36} p50 {:>10.3f} ms  p90 {:>10.3f} ms".format(label, stats["p50_ms"], stats["p90_ms"])
+    if args["compare"]:
+        compare(results, args["compare"])
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args)
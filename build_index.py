@@ -0,0 +1,61 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Compiles the CMU Pronouncing Dictionary and the custom pronunciations
+# in the collection files into a phonetic index for sonnet.py, and
+# optionally snapshots the filtered Brown corpus word lists and indexes
+# the collections' WordNet senses.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sonnet as snt
+import argparse
+import sys
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Compiles the pronouncing dictionary into a phonetic index.")
+    parser.add_argument("--output",
+                        "-o",
+                        default=snt.PHONETIC_INDEX,
+                        help="Index filename (Default: {})".format(snt.PHONETIC_INDEX))
+    parser.add_argument("--vocab",
+                        "-v",
+                        action="store_true",
+                        help="Also rebuild the vocabulary snapshot ({})".format(snt.VOCAB_SNAPSHOT))
+    parser.add_argument("--similarity",
+                        action="store_true",
+                        help="Also rebuild the collections' WordNet index ({})".format(snt.SIMILARITY_INDEX))
+    parsed_args = parser.parse_args(args)
+    return vars(parsed_args)
+
+
+def main(args):
+    snt.build_phonetic_index(args["output"])
+    if args["vocab"] or args["similarity"]:
+        vocab = snt.Vocab()
+        if args["vocab"]:
+            vocab.save_snapshot()
+        if args["similarity"]:
+            snt.SimilarityIndex.build(vocab.collections).save(snt.SIMILARITY_INDEX,
+                                                              snt.SimilarityIndex.key(vocab.coll_files))
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -0,0 +1,279 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Saves and loads the rating models as a bundle: a directory holding the
+# vocabulary as flat arrays, the classifiers, and a manifest with their hashes.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+import argparse
+import sys
+import os
+import glob
+import json
+import shutil
+import hashlib
+import datetime
+import logging
+from itertools import chain, islice
+
+BUNDLE_ROOT = "models"
+BUNDLE_FORMAT = 1
+MANIFEST = "manifest.json"
+VERIFIED = "verified.json"
+VOCAB = "vocab.npz"
+HUM_MODEL = "hum_classifier"
+INT_MODEL = "int_classifier"
+
+
+class BundleError(Exception):
+    pass
+
+
+def encode_seqs(mapping, max_seq_len, n_words, seqs, dtype=np.int64):
+    """Encodes a batch of sequences as one (len(seqs), max_seq_len) matrix of
+    vocabulary ids. Unknown items are 0, as is the padding after short sequences.
+    A smaller dtype (np.int32, np.int16) saves memory if the vocabulary fits."""
+    if n_words > np.iinfo(dtype).max + 1:
+        raise ValueError("{} words don't fit in {}".format(n_words, np.dtype(dtype).name))
+    lengths = np.fromiter((min(len(seq), max_seq_len) for seq in seqs), np.intp, len(seqs))
+    items = list(chain.from_iterable(islice(seq, max_seq_len) for seq in seqs))
+    ids = np.fromiter((mapping.get(item, 0) for item in items), dtype, len(items))
+    x = np.zeros((len(seqs), max_seq_len), dtype)
+    # Row by row, the mask picks out the same positions the items were flattened from
+    x[np.arange(max_seq_len) < lengths[:, np.newaxis]] = ids
+    return x
+
+
+def to_unicode(item):
+    if isinstance(item, unicode):
+        return item
+    return item.decode("utf-8")
+
+
+def by_id(mapping):
+    """The keys of an item -> id mapping, as an array indexed by id."""
+    return np.array([to_unicode(item) for item, _ in sorted(mapping.items(), key=lambda pair: pair[1])],
+                    dtype=np.unicode_)
+
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify_files(directory, files):
+    """Checks every file against its hash in the manifest. The hashes are
+    remembered along with each file's size and mtime, so an unchanged
+    bundle isn't read in full every time the scorer starts."""
+    cache_fn = os.path.join(directory, VERIFIED)
+    try:
+        with open(cache_fn, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    checked = {}
+    for path, expected in sorted(files.items()):
+        filename = os.path.join(directory, path)
+        if not os.path.exists(filename):
+            raise BundleError("{} is missing {}".format(directory, path))
+        stat = os.stat(filename)
+        stamp = [stat.st_size, stat.st_mtime]
+        cached = cache.get(path)
+        actual = cached[2] if cached and cached[:2] == stamp else file_hash(filename)
+        if actual != expected:
+            raise BundleError("{} has been changed since {} was bundled".format(path, directory))
+        checked[path] = stamp + [actual]
+    if checked != cache:
+        try:
+            with open(cache_fn, "w") as f:
+                json.dump(checked, f)
+        except (IOError, OSError) as e:
+            # A read-only bundle is just hashed in full every time
+            logging.debug("Can't save verified hashes in {}: {}".format(directory, e))
+
+
+def bundle_files(directory):
+    """Every file in a bundle except the manifest and the verified hashes,
+    as paths relative to it."""
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), directory)
+            if path not in (MANIFEST, VERIFIED):
+                files.append(path)
+    return sorted(files)
+
+
+def new_bundle_dir(root=BUNDLE_ROOT):
+    timestamp = datetime.datetime.today().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(root, "bundle_{}".format(timestamp))
+
+
+class ModelBundle(object):
+    """What the scorer needs from a trained model: the vocabulary, the
+    rating classes, the sequence length and where the classifiers are.
+
+    Stands in for model.ModelConfig wherever sequences are encoded."""
+
+    def __init__(self, words, hum_classes, int_classes, max_seq_len, embedding_size, directory=None, manifest=None):
+        self.words = words
+        self.hum_classes = hum_classes
+        self.int_classes = int_classes
+        self.mapping = {}
+        for index, word in enumerate(words.tolist()):
+            self.mapping[word] = index
+            # Sequences read from old pickles hold byte strings, not unicode
+            try:
+                word.encode("ascii")
+            except UnicodeEncodeError:
+                self.mapping[word.encode("utf-8")] = index
+        self.n_words = len(words)
+        self.max_seq_len = max_seq_len
+        self.embedding_size = embedding_size
+        self.directory = directory
+        self.manifest = manifest or {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Takes the vocabulary and classes from a trained model.ModelConfig."""
+        return cls(by_id(config.transform_matrix._mapping),
+                   by_id(config.hum_cv._mapping),
+                   by_id(config.int_cv._mapping),
+                   config.max_seq_len,
+                   config.embedding_size)
+
+    def transform_seqs(self, seqs, dtype=np.int64):
+        return encode_seqs(self.mapping, self.max_seq_len, self.n_words, seqs, dtype)
+
+    def model_path(self, name):
+        return os.path.join(self.directory, self.manifest["models"][name])
+
+    def save(self, directory):
+        """Writes the vocabulary and the manifest. The classifiers should
+        already be saved in the directory, since the manifest hashes
+        everything in it, and a bundle without a manifest is ignored."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez(os.path.join(directory, VOCAB),
+                 words=self.words,
+                 hum_classes=self.hum_classes,
+                 int_classes=self.int_classes)
+        models = {}
+        for name, path in [("hum", HUM_MODEL), ("int", INT_MODEL)]:
+            if os.path.exists(os.path.join(directory, path)):
+                models[name] = path
+        self.manifest = {"format": BUNDLE_FORMAT,
+                         "created": datetime.datetime.today().strftime("%Y-%m-%dT%H:%M:%S"),
+                         "max_seq_len": self.max_seq_len,
+                         "embedding_size": self.embedding_size,
+                         "n_words": self.n_words,
+                         "models": models,
+                         "files": dict((path, file_hash(os.path.join(directory, path)))
+                                       for path in bundle_files(directory))}
+        # Written last, so a half-written bundle is never picked up
+        with open(os.path.join(directory, MANIFEST), "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        self.directory = directory
+
+    @classmethod
+    def load(cls, directory, verify=True):
+        """Raises BundleError if the bundle is incomplete, from a different
+        format or, with verify, if any file doesn't match its hash."""
+        manifest = read_manifest(directory)
+        if verify:
+            verify_files(directory, manifest["files"])
+        arrays = np.load(os.path.join(directory, VOCAB))
+        try:
+            bundle = cls(arrays["words"], arrays["hum_classes"], arrays["int_classes"],
+                         manifest["max_seq_len"], manifest["embedding_size"], directory, manifest)
+        finally:
+            arrays.close()
+        if bundle.n_words != manifest["n_words"]:
+            raise BundleError("{} has {} words, its manifest says {}".format(directory, bundle.n_words,
+                                                                           manifest["n_words"]))
+        return bundle
+
+
+def read_manifest(directory):
+    filename = os.path.join(directory, MANIFEST)
+    if not os.path.exists(filename):
+        raise BundleError("No manifest in {}".format(directory))
+    with open(filename, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise BundleError("{} is bundle format {}, expected {}".format(directory, manifest.get("format"),
+                                                                      BUNDLE_FORMAT))
+    return manifest
+
+
+def load_latest_bundle(root=BUNDLE_ROOT, verify=True):
+    """The newest bundle under root that loads, and with verify matches its
+    hashes, or None if there isn't one. Broken bundles are skipped."""
+    # Bundle names are timestamps, so the newest sorts last
+    for directory in sorted(glob.glob(os.path.join(root, "bundle_*")), reverse=True):
+        try:
+            return ModelBundle.load(directory, verify)
+        except (BundleError, ValueError, IOError) as e:
+            logging.warning("Skipping {}: {}".format(directory, e))
+    return None
+
+
+def latest_bundle(root=BUNDLE_ROOT):
+    """The directory of the newest bundle that loads, or None."""
+    newest = load_latest_bundle(root)
+    return newest.directory if newest else None
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Converts a pickled model config and its classifiers to a model bundle.")
+    parser.add_argument("config",
+                        help="Model config pickle written by model.py")
+    parser.add_argument("hum_model",
+                        help="Humanity classifier directory")
+    parser.add_argument("int_model",
+                        help="Interest classifier directory")
+    parser.add_argument("--root",
+                        default=BUNDLE_ROOT,
+                        help="Where to put the bundle (Default: {})".format(BUNDLE_ROOT))
+    parsed_args = parser.parse_args(args)
+    return vars(parsed_args)
+
+
+def main(args):
+    import pickle
+    # Unpickling the config needs model.py's classes
+    import model
+    with open(args["config"], "rb") as f:
+        config = pickle.load(f)
+    directory = new_bundle_dir(args["root"])
+    os.makedirs(directory)
+    shutil.copytree(args["hum_model"], os.path.join(directory, HUM_MODEL))
+    shutil.copytree(args["int_model"], os.path.join(directory, INT_MODEL))
+    ModelBundle.from_config(config).save(directory)
+    print "Saved {}".format(directory)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args(sys.argv[1:])
+    main(args)
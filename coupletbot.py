@@ -20,62 +20,56 @@
 
 
 import sonnet as snt
-from tensorflow.contrib import skflow
-import model
-from model import ModelConfig
+import scorer
 import logging
 import tweepy
 from secrets import *
 import datetime
 import time
-import pickle
+import urllib2
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Generate couplets:
-vocab = snt.Vocab()
-sw = snt.SonnetWriter(vocab)
-sw.load_templates("line_templates.csv")
-
-vocab.add_random_collections(2)
-couplets = snt.HeroicCouplets(12)
-
-sw.new_poem(couplets)
-
-# Load rating model:
-logging.info("Loading model config...")
-with open("models/model_config_20160520.pickle") as f:
-    config = pickle.load(f)
-logging.info("Done.")
-logging.info("Loading humanity model...")
-hum_classifier = skflow.TensorFlowEstimator.restore("models/hum_classifier_20160520")
-logging.info("Done.")
-logging.info("Loading interest model...")
-int_classifier = skflow.TensorFlowEstimator.restore("models/int_classifier_20160520")
-logging.info("Done.")
-
-
-seqs = [model.convert_to_sequence(section) for section in couplets.sections]
-x = config.transform_seqs(seqs)
-
-
-def sum_ratings(probs):
-    return sum([prob * rating for prob, rating in zip(probs, range(4))])
-
-# Rate each couplet and sort by ratings:
-hum_ratings = [sum_ratings(probs) * 3 for probs in hum_classifier.predict_proba(x)]
-int_ratings = [sum_ratings(probs) * 3 for probs in int_classifier.predict_proba(x)]
+NUM_COUPLETS = 12
+NUM_TO_TWEET = 2
 
-for section, hum_rat, int_rat in zip(couplets.sections, hum_ratings, int_ratings):
-    section.human = hum_rat
-    section.interesting = int_rat
 
+def fetch_couplets():
+    """Returns the couplets, and whether they are only the best few picked
+    from the pipeline rather than a whole batch."""
+    # Best: take the top of a running scorer's pipeline. Next best: have a
+    # running scorer write a batch. Last resort: load everything here.
+    try:
+        couplets = scorer.request_best(NUM_TO_TWEET)
+        if couplets.sections:
+            logging.info("Couplets taken from the running scorer's pipeline.")
+            return couplets, True
+    except urllib2.URLError as e:
+        logging.info("No scorer pipeline ({}).".format(e.reason))
+    try:
+        couplets = scorer.request_couplets(NUM_COUPLETS)
+        logging.info("Couplets written by the running scorer.")
+        return couplets, False
+    except urllib2.URLError as e:
+        logging.info("No scorer running ({}), loading everything here...".format(e.reason))
+    local_scorer = scorer.CoupletScorer()
+    couplets = local_scorer.write_couplets(NUM_COUPLETS)
+    local_scorer.rate(couplets)
+    return couplets, False
+
+
+# Generate and rate couplets:
+couplets, selected = fetch_couplets()
+
+# A whole batch is kept for rating later; couplets picked from the pipeline
+# are only the ones about to be tweeted, so they're saved under another name
 timestamp = datetime.datetime.now()
-filename = "unrated_couplet_batch_{}.pickle".format(timestamp.strftime("%Y%m%d-%H%M"))
-with open(filename, "wb") as f:
-    pickle.dump(couplets, f)
+prefix = "selected_couplets" if selected else "unrated_couplet_batch"
+filename = "{}_{}.jsonl".format(prefix, timestamp.strftime("%Y%m%d-%H%M"))
+with snt.PoemWriter(filename) as output:
+    output.write(couplets)
 
 couplets.sections.sort(key=lambda x: x.human * x.interesting)
 couplets.sections.reverse()
@@ -86,8 +80,6 @@ auth.set_access_token(A_TOKEN, A_TOKEN_SECRET)
 api = tweepy.API(auth)
 
 
-NUM_TO_TWEET = 2
-
 for couplet in couplets.sections[:NUM_TO_TWEET]:
     api.update_status(couplet.text)
     time.sleep(30)
\ No newline at end of file
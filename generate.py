@@ -23,6 +23,12 @@ import sonnet as snt
 import pickle
 import argparse
 import sys
+import random
+import logging
+import multiprocessing
+import signal
+
+writer = None
 
 
 def parse_args(args):
@@ -36,26 +42,94 @@ def parse_args(args):
     parser.add_argument("--output",
                         "-o",
                         required=True,
-                        help="Output filename (Required)")
+                        help="Output filename (Required). Poems are appended one JSON record per line, "
+                             "unless it ends in .pickle")
+    parser.add_argument("--workers",
+                        "-w",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes (Default: 1)")
+    parser.add_argument("--seed",
+                        "-s",
+                        type=int,
+                        default=None,
+                        help="Base random seed, for reproducible batches (Default: random)")
     parsed_args = parser.parse_args(args)
     return vars(parsed_args)
 
 
-def main(args):
-    v = snt.Vocab()
+def make_writer():
+    v = snt.Vocab.from_snapshot()
     sw = snt.SonnetWriter(v)
     sw.load_templates("line_templates.csv")
+    return sw
+
+
+def write_sonnet(seed):
+    # Each sonnet gets its own seed, so a batch comes out the same
+    # however it is split between workers.
+    global writer
+    if writer is None:
+        writer = make_writer()
+    writer.seed(seed)
+    writer.vocab.add_random_collections()
+    s = snt.Sonnet()
+    writer.new_poem(s)
+    writer.vocab.clear_collections()
+    return s
+
+
+def ignore_interrupts():
+    # Ctrl-C is left to the parent, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def pool_results(results, poll=1.0):
+    """Yields from a Pool.imap iterator. The wait is timed because Python 2
+    can't deliver Ctrl-C to an untimed one."""
+    while True:
+        try:
+            yield results.next(poll)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def main(args):
+    global writer
+    # Load everything once up front; forked workers share it.
+    writer = make_writer()
+    base_seed = args["seed"] if args["seed"] is not None else random.randrange(2 ** 32)
+    logging.info("Base seed: {}".format(base_seed))
+    seeds = [base_seed + index for index in xrange(args["number"])]
 
-    sonnets = []
-    while len(sonnets) < args["number"]:
-        sw.vocab.add_random_collections()
-        s = snt.Sonnet()
-        sw.new_poem(s)
-        sw.vocab.clear_collections()
-        sonnets.append(s)
+    pool = None
+    if args["workers"] > 1:
+        pool = multiprocessing.Pool(args["workers"], ignore_interrupts)
+        sonnet_stream = pool_results(pool.imap(write_sonnet, seeds))
+    else:
+        sonnet_stream = (write_sonnet(seed) for seed in seeds)
 
-    with open(args["output"], "wb") as f:
-        pickle.dump(sonnets, f)
+    try:
+        if args["output"].endswith(".pickle"):
+            sonnets = list(sonnet_stream)
+            with open(args["output"], "wb") as f:
+                pickle.dump(sonnets, f)
+        else:
+            with snt.PoemWriter(args["output"]) as output:
+                for count, s in enumerate(sonnet_stream):
+                    output.write(s)
+                    logging.info("Sonnet {} of {} saved.".format(count + 1, args["number"]))
+    except BaseException:
+        # A failed worker or Ctrl-C: don't leave the other workers running
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
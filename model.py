@@ -23,8 +23,11 @@ import numpy as np
 import tensorflow as tf
 import sklearn
 import glob
-import datetime
-from sonnet import Poem
+import os
+from collections import OrderedDict
+from itertools import chain
+from sonnet import Poem, read_poems
+from bundle import ModelBundle, encode_seqs, new_bundle_dir, HUM_MODEL, INT_MODEL
 
 def convert_to_sequence(section):
     sequence = []
@@ -54,9 +57,12 @@ class ModelConfig(object):
         self.embedding_size = 50
 
     def initialize_transform_matrix(self, seqs):
-        for seq in seqs:
-            for item in seq:
-                self.transform_matrix.add(item)
+        # Count everything first, so each item is added once (in order of first appearance)
+        counts = OrderedDict()
+        for item in chain.from_iterable(seqs):
+            counts[item] = counts.get(item, 0) + 1
+        for item, count in counts.iteritems():
+            self.transform_matrix.add(item, count)
         self.transform_matrix.freeze()
         self.n_words = len(self.transform_matrix._mapping)
         self.max_seq_len = max([len(seq) for seq in seqs])
@@ -73,17 +79,8 @@ class ModelConfig(object):
         y = np.array(list(transform_cat(binned_ratings)))
         return y
 
-    def transform_seqs(self, seqs):
-        def transformer():
-            for seq in seqs:
-                choice_ids = np.zeros(self.max_seq_len, np.int64)
-                for index, choice in enumerate(seq):
-                    if index >= self.max_seq_len:
-                        break
-                    choice_ids[index] = self.transform_matrix.get(choice)
-                yield (choice_ids)
-        x = np.array(list(transformer()))
-        return x
+    def transform_seqs(self, seqs, dtype=np.int64):
+        return encode_seqs(self.transform_matrix._mapping, self.max_seq_len, self.n_words, seqs, dtype)
 
 if __name__ == "__main__":
     rated_batches = glob.glob("rated/*.pickle")
@@ -97,6 +94,9 @@ if __name__ == "__main__":
             elif isinstance(contents, Poem):
                 rated_sonnets.append(contents)
 
+    for batch in glob.glob("rated/*.jsonl"):
+        rated_sonnets.extend(read_poems(batch))
+
     seqs = [convert_to_sequence(section) for sonnet in rated_sonnets for section in sonnet.sections]
     human_score_cat = [bin_rating(section.human, 4, 6) for sonnet in rated_sonnets for section in sonnet.sections]
     interest_score_cat = [bin_rating(section.interesting, 4, 7) for sonnet in rated_sonnets for section in
@@ -113,9 +113,8 @@ if __name__ == "__main__":
     int_y = config.prepare_rating_cats(config.int_cv, interest_score_cat)
     hum_y = config.prepare_rating_cats(config.hum_cv, human_score_cat)
 
-    datestamp = datetime.datetime.today().strftime("%Y%m%d")
-    with open("models/model_config_{}.pickle".format(datestamp), "wb") as f:
-        pickle.dump(config, f)
+    bundle_dir = new_bundle_dir()
+    os.makedirs(bundle_dir)
 
     x_train, x_test, int_y_train, int_y_test = sklearn.cross_validation.train_test_split(x, int_y,
                                                                                          test_size=100, random_state=1)
@@ -148,7 +147,7 @@ if __name__ == "__main__":
     score = sklearn.metrics.accuracy_score(int_y_test, classifier.predict(x_test))
     print("Accuracy: {0:f}".format(score))
 
-    classifier.save("models/int_classifier_{}".format(datestamp))
+    classifier.save(os.path.join(bundle_dir, INT_MODEL))
 
     x_train, x_test, hum_y_train, hum_y_test = sklearn.cross_validation.train_test_split(x, hum_y,
                                                                                          test_size=100, random_state=1)
@@ -160,4 +159,8 @@ if __name__ == "__main__":
     score = sklearn.metrics.accuracy_score(hum_y_test, classifier.predict(x_test))
     print("Accuracy: {0:f}".format(score))
 
-    classifier.save("models/hum_classifier_{}".format(datestamp))
+    classifier.save(os.path.join(bundle_dir, HUM_MODEL))
+
+    # The manifest goes in last, once everything it hashes is saved
+    ModelBundle.from_config(config).save(bundle_dir)
+    print("Saved {}".format(bundle_dir))
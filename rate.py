@@ -2,8 +2,8 @@
 # Email: russell.d.williams@gmail.com
 # Copyright 2016
 
-# Gathers user ratings, section-by-section, of a pickled file of
-# poems generated by sonnet.py
+# Gathers user ratings, section-by-section, of a file of poems
+# generated by sonnet.py (poem records, or a pickle)
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -20,8 +20,10 @@
 
 
 
+import sonnet as snt
 import pickle
 import argparse
+import os
 import sys
 
 
@@ -37,6 +39,8 @@ def parse_args(args):
                         required = True,
                         help = "Output filename (Required)")
     parsed_args = parser.parse_args(args)
+    if os.path.realpath(parsed_args.input) == os.path.realpath(parsed_args.output):
+        parser.error("the output must be a different file from the input")
     return vars(parsed_args)
 
 def rate_section(section):
@@ -49,7 +53,28 @@ def rate_sonnet(sonnet):
         rate_section(section)
 
 
+def written_poems(filename):
+    """The texts of the poems already in an output file, so an interrupted
+    session can pick up where it stopped."""
+    if not os.path.exists(filename):
+        return set()
+    return set(poem.text for poem in snt.read_poems(filename))
+
+
 def main(args):
+    if not args["input"].endswith(".pickle"):
+        # Poem records: each one is written out as soon as it has been rated
+        done = written_poems(args["output"])
+        with snt.PoemWriter(args["output"]) as output:
+            for sonnet in snt.read_poems(args["input"]):
+                if sonnet.text in done:
+                    continue
+                done.add(sonnet.text)
+                if not sonnet.sections[0].interesting:
+                    rate_sonnet(sonnet)
+                output.write(sonnet)
+        return
+
     with open(args["input"], "r") as f:
         all_sonnets = pickle.load(f)
     unrated_sonnets = [sonnet for sonnet in all_sonnets if not sonnet.sections[0].interesting]
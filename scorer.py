@@ -0,0 +1,404 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Keeps the vocabulary, templates and rating models loaded in one
+# long-running process, and writes and rates couplets for clients
+# such as coupletbot.py over local HTTP. Worker processes can keep
+# writing couplets in the background, so the best ones are ready
+# before anyone asks.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sonnet as snt
+import generate
+import bundle
+import argparse
+import sys
+import json
+import pickle
+import logging
+import urllib2
+import random
+import time
+import heapq
+import threading
+import multiprocessing
+import Queue
+from itertools import count
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MODEL_CONFIG = "models/model_config_20160520.pickle"
+HUM_CLASSIFIER = "models/hum_classifier_20160520"
+INT_CLASSIFIER = "models/int_classifier_20160520"
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Serves couplet writing and rating from one warm process.")
+    parser.add_argument("--host",
+                        default=DEFAULT_HOST,
+                        help="Address to listen on (Default: {})".format(DEFAULT_HOST))
+    parser.add_argument("--port",
+                        "-p",
+                        type=int,
+                        default=DEFAULT_PORT,
+                        help="Port to listen on (Default: {})".format(DEFAULT_PORT))
+    parser.add_argument("--bundle",
+                        "-b",
+                        default=None,
+                        help="Model bundle (Default: the newest under {})".format(bundle.BUNDLE_ROOT))
+    parser.add_argument("--config",
+                        default=None,
+                        help="Old-style model config pickle, used instead of a bundle")
+    parser.add_argument("--hum-model",
+                        default=HUM_CLASSIFIER,
+                        help="Humanity classifier to go with --config (Default: {})".format(HUM_CLASSIFIER))
+    parser.add_argument("--int-model",
+                        default=INT_CLASSIFIER,
+                        help="Interest classifier to go with --config (Default: {})".format(INT_CLASSIFIER))
+    parser.add_argument("--workers",
+                        "-w",
+                        type=int,
+                        default=1,
+                        help="Processes writing couplets in the background, 0 for none (Default: 1)")
+    parser.add_argument("--queue-size",
+                        type=int,
+                        default=200,
+                        help="Couplets waiting to be rated before the workers pause (Default: 200)")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=64,
+                        help="Most couplets rated in one batch (Default: 64)")
+    parser.add_argument("--buffer-size",
+                        type=int,
+                        default=500,
+                        help="Best rated couplets kept ready (Default: 500)")
+    parsed_args = parser.parse_args(args)
+    return vars(parsed_args)
+
+
+def sum_ratings(probs):
+    return sum([prob * rating for prob, rating in zip(probs, range(4))])
+
+
+class CoupletScorer(object):
+    """Everything it takes to write and rate couplets, loaded once."""
+
+    def __init__(self, bundle_dir=None, config_fn=None, hum_fn=HUM_CLASSIFIER, int_fn=INT_CLASSIFIER):
+        """Loads bundle_dir, or the newest bundle if it's None. A config_fn
+        pickle and its classifiers are used instead if given, or if there
+        are no bundles yet."""
+        # TensorFlow takes a long time to import, so clients that only talk
+        # to a running scorer never pay for it.
+        from tensorflow.contrib import skflow
+        import model
+        self.model = model
+
+        self.vocab = snt.Vocab.from_snapshot()
+        self.writer = snt.SonnetWriter(self.vocab)
+        self.writer.load_templates("line_templates.csv")
+
+        self.config = None
+        if config_fn is None and bundle_dir is None:
+            logging.info("Loading the newest model bundle in {}...".format(bundle.BUNDLE_ROOT))
+            self.config = bundle.load_latest_bundle()
+            if self.config is None:
+                logging.warning("No usable model bundles in {}, using {}.".format(bundle.BUNDLE_ROOT, MODEL_CONFIG))
+                config_fn = MODEL_CONFIG
+        elif config_fn is None:
+            logging.info("Loading model bundle {}...".format(bundle_dir))
+            self.config = bundle.ModelBundle.load(bundle_dir)
+        if self.config is not None:
+            hum_fn = self.config.model_path("hum")
+            int_fn = self.config.model_path("int")
+        else:
+            logging.info("Loading model config {}...".format(config_fn))
+            with open(config_fn) as f:
+                self.config = pickle.load(f)
+        logging.info("Done.")
+        logging.info("Loading humanity model...")
+        self.hum_classifier = skflow.TensorFlowEstimator.restore(hum_fn)
+        logging.info("Done.")
+        logging.info("Loading interest model...")
+        self.int_classifier = skflow.TensorFlowEstimator.restore(int_fn)
+        logging.info("Done.")
+        # The pipeline rates from its own thread
+        self.lock = threading.Lock()
+
+    def write_couplets(self, number, collections=2, seed=None):
+        if seed is not None:
+            self.writer.seed(seed)
+        self.vocab.add_random_collections(collections)
+        couplets = snt.HeroicCouplets(number)
+        try:
+            self.writer.new_poem(couplets)
+        finally:
+            self.vocab.clear_collections()
+        return couplets
+
+    def rate(self, poem):
+        self.rate_sections(poem.sections)
+        return poem
+
+    def rate_sections(self, sections):
+        seqs = [self.model.convert_to_sequence(section) for section in sections]
+        x = self.config.transform_seqs(seqs)
+        with self.lock:
+            hum_probs = self.hum_classifier.predict_proba(x)
+            int_probs = self.int_classifier.predict_proba(x)
+        for section, hum_prob, int_prob in zip(sections, hum_probs, int_probs):
+            section.human = float(sum_ratings(hum_prob) * 3)
+            section.interesting = float(sum_ratings(int_prob) * 3)
+        return sections
+
+
+def couplet_score(section):
+    return section.human * section.interesting
+
+
+class RankedBuffer(object):
+    """Keeps the best maxsize items pushed into it, by score."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.heap = []
+        # Breaks ties between equal scores, so items themselves are never compared
+        self.counter = count()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, score, item):
+        with self.condition:
+            entry = (score, next(self.counter), item)
+            if len(self.heap) < self.maxsize:
+                heapq.heappush(self.heap, entry)
+            else:
+                # Drops whichever is worst, possibly the new item
+                heapq.heappushpop(self.heap, entry)
+            self.condition.notify_all()
+
+    def take(self, number, timeout=None):
+        """Removes and returns the best number items, best first. Waits up to
+        timeout seconds for enough, then returns however many there are."""
+        deadline = time.time() + (timeout or 0)
+        with self.condition:
+            while len(self.heap) < number and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            best = heapq.nlargest(number, self.heap)
+            taken = set(id(entry) for entry in best)
+            self.heap = [entry for entry in self.heap if id(entry) not in taken]
+            heapq.heapify(self.heap)
+        return [item for _, _, item in best]
+
+
+def produce_couplets(queue, seed, couplets_per_poem=12):
+    """Worker process: writes couplets forever. While the queue is full,
+    it makes lines for the next poem and keeps them in a reservoir."""
+    writer = generate.make_writer()
+    writer.reservoir = snt.CandidateReservoir()
+    writer.seed(seed)
+    writer.vocab.add_random_collections()
+    poems = 0
+    while True:
+        couplets = snt.HeroicCouplets(couplets_per_poem)
+        writer.new_poem(couplets)
+        poems += 1
+        if poems % 50 == 0:
+            logging.info("Candidate reservoir: {}".format(writer.reservoir.stats()))
+        # The next poem's collections, so lines made while waiting are filed under them
+        writer.vocab.clear_collections()
+        writer.vocab.add_random_collections()
+        for section in couplets.sections:
+            record = section.to_record()
+            while True:
+                try:
+                    queue.put(record, timeout=0.1)
+                    break
+                except Queue.Full:
+                    if not writer.refill_reservoir():
+                        # Nothing worth making, so wait for room instead of spinning
+                        queue.put(record)
+                        break
+
+
+class CoupletPipeline(object):
+    """Worker processes write couplets into a bounded queue; a thread
+    here rates them in batches and keeps the best in a RankedBuffer."""
+
+    def __init__(self, workers=1, queue_size=200, batch_size=64, buffer_size=500):
+        self.queue = multiprocessing.Queue(queue_size)
+        self.batch_size = batch_size
+        self.buffer = RankedBuffer(buffer_size)
+        self.rated = 0
+        self.producers = [multiprocessing.Process(target=produce_couplets, args=(self.queue, random.randrange(2 ** 32)))
+                          for _ in xrange(workers)]
+        self.consumer = None
+        self.stopping = threading.Event()
+
+    def start_producers(self):
+        # Fork before the models are loaded, so workers don't inherit TensorFlow
+        for producer in self.producers:
+            producer.daemon = True
+            producer.start()
+
+    def start(self, scorer):
+        self.scorer = scorer
+        self.consumer = threading.Thread(target=self.rate_batches)
+        self.consumer.daemon = True
+        self.consumer.start()
+
+    def next_batch(self):
+        records = [self.queue.get(timeout=1)]
+        try:
+            while len(records) < self.batch_size:
+                records.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return records
+
+    def rate_batches(self):
+        while not self.stopping.is_set():
+            try:
+                records = self.next_batch()
+            except Queue.Empty:
+                continue
+            sections = [snt.Section.from_record(record) for record in records]
+            self.scorer.rate_sections(sections)
+            for section in sections:
+                self.buffer.push(couplet_score(section), section)
+            self.rated += len(sections)
+            logging.debug("Rated {} couplets, {} buffered.".format(self.rated, len(self.buffer)))
+
+    def best(self, number, timeout=60):
+        couplets = snt.HeroicCouplets(0)
+        couplets.sections = self.buffer.take(number, timeout)
+        couplets.section_lengths = [len(section.template_list) for section in couplets.sections]
+        couplets.text = "".join([section.text for section in couplets.sections])
+        return couplets
+
+    def stop(self):
+        self.stopping.set()
+        for producer in self.producers:
+            producer.terminate()
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """POST /couplets {"number": 12, "collections": 2, "seed": null} writes and rates couplets.
+    POST /rate {"poem": <record>} rates a poem saved by PoemWriter.
+    POST /best {"number": 2, "timeout": 60} takes the best couplets the pipeline has rated.
+    GET /health says whether the scorer is up, and how full the pipeline is.
+    Poems go both ways as the records PoemWriter saves."""
+
+    def do_GET(self):
+        if self.path == "/health":
+            status = {"status": "ok"}
+            if self.server.pipeline:
+                status.update({"rated": self.server.pipeline.rated, "buffered": len(self.server.pipeline.buffer)})
+            self.respond(200, status)
+        else:
+            self.respond(404, {"error": "Unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader("content-length") or 0)
+            request = json.loads(self.rfile.read(length) or "{}")
+            if self.path == "/couplets":
+                poem = self.server.scorer.write_couplets(int(request.get("number", 12)),
+                                                         int(request.get("collections", 2)),
+                                                         request.get("seed"))
+            elif self.path == "/rate":
+                poem = snt.Poem.from_record(request["poem"])
+            elif self.path == "/best" and self.server.pipeline:
+                poem = self.server.pipeline.best(int(request.get("number", 2)), float(request.get("timeout", 60)))
+                self.respond(200, {"poem": poem.to_record()})
+                return
+            else:
+                self.respond(404, {"error": "Unknown path: {}".format(self.path)})
+                return
+            self.server.scorer.rate(poem)
+            self.respond(200, {"poem": poem.to_record()})
+        except (ValueError, KeyError, TypeError) as e:
+            self.respond(400, {"error": str(e)})
+
+    def respond(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ScoringServer(HTTPServer):
+    # Requests are handled one at a time: neither the writer nor the
+    # classifiers can be shared between threads.
+    def __init__(self, address, scorer, pipeline=None):
+        HTTPServer.__init__(self, address, ScoringHandler)
+        self.scorer = scorer
+        self.pipeline = pipeline
+
+
+def request(path, body, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=600):
+    """Sends a request to a running scorer. Raises urllib2.URLError if there isn't one."""
+    url = "http://{}:{}{}".format(host, port, path)
+    response = urllib2.urlopen(urllib2.Request(url, json.dumps(body), {"Content-Type": "application/json"}),
+                               timeout=timeout)
+    return json.loads(response.read())
+
+
+def request_couplets(number, collections=2, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    record = request("/couplets", {"number": number, "collections": collections}, host, port)["poem"]
+    return snt.Poem.from_record(record)
+
+
+def request_best(number, timeout=60, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """The best couplets rated so far by a running scorer's pipeline,
+    best first. Raises urllib2.URLError if there's no pipeline running."""
+    record = request("/best", {"number": number, "timeout": timeout}, host, port, timeout=timeout + 30)["poem"]
+    return snt.Poem.from_record(record)
+
+
+def main(args):
+    pipeline = None
+    if args["workers"] > 0:
+        pipeline = CoupletPipeline(args["workers"], args["queue_size"], args["batch_size"], args["buffer_size"])
+        pipeline.start_producers()
+    couplet_scorer = CoupletScorer(args["bundle"], args["config"], args["hum_model"], args["int_model"])
+    if pipeline:
+        pipeline.start(couplet_scorer)
+    server = ScoringServer((args["host"], args["port"]), couplet_scorer, pipeline)
+    logging.info("Scoring on {}:{}".format(args["host"], args["port"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pipeline:
+            pipeline.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -22,18 +22,30 @@ import logging
 import re
 import random
 import csv
+import string
 import glob
-from itertools import tee, islice, chain, izip
+import os
+import mmap
+import struct
+import hashlib
+import threading
+import json
+import cPickle as pickle
+from collections import OrderedDict
+from itertools import tee, islice, chain, izip, product
 from nltk.corpus import wordnet as wn
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Import the CMU Pronouncing Dictionary as a dictionary
-logging.info("Loading dictionary...")
-dictionary = nltk.corpus.cmudict.dict()
-logging.info("Done.")
+PHONETIC_INDEX = "phonetic_index.bin"
+VOCAB_SNAPSHOT = "vocab_snapshot.pickle"
+SIMILARITY_INDEX = "similarity_index.pickle"
+IAMBIC_PENTAMETER = "ususususus"
+BLANK_MARK = "zzblank{}zz"
+blank_marks = re.compile("^zzblank([0-9]+)zz(.*)$")
+any_blank_mark = re.compile("zzblank[0-9]+zz")
 
 syllable_marks = re.compile("0|1|2")
 stressed_syllable_marks = re.compile("1|2")
@@ -56,6 +68,421 @@ similar_sounds = {"EH": ["IH"],
                   "S": ["Z"]
 }
 
+# Fold each group of similar sounds into one symbol, so that slant rhymes
+# share a rhyme key with exact rhymes.
+canonical_sounds = dict((sound, min([sound] + similar)) for sound, similar in similar_sounds.items())
+
+
+def rhyme_key(sound):
+    return tuple(canonical_sounds.get(symbol, symbol) for symbol in sound)
+
+
+def stresses(syl_string):
+    stresses = []
+    if len(syl_string) == 1:
+        stresses.append("x")
+    else:
+        previous_syls, syls, next_syls = tee(syl_string, 3)
+        next_syls = chain(islice(next_syls, 1, None), [None])
+        previous_syls = chain([None], previous_syls)
+        linked_syls = izip(previous_syls, syls, next_syls)
+        for prev, syl, next in linked_syls:
+            if syl == 1:
+                stresses.append("s")
+            elif syl == 2:
+                # For secondary stress, it's unstressed if next to a primary stress
+                # and stressed otherwise
+                if next == 1 or prev == 1:
+                    stresses.append("u")
+                else:
+                    stresses.append("s")
+            else:
+                stresses.append("u")
+    return "".join(stresses)
+
+
+def make_syl_string(pron):
+    syl_string = []
+    for symbol in pron:
+        if "0" in symbol:
+            syl_string.append(0)
+        elif "1" in symbol:
+            syl_string.append(1)
+        elif "2" in symbol:
+            syl_string.append(2)
+    return stresses(syl_string)
+
+
+def last_sound(pron):
+    for index, sound in enumerate(reversed(pron)):
+        if stressed_syllable_marks.search(sound):
+            return [sound.strip("012") for sound in pron[-(index + 1):]]
+
+
+def files_digest(filenames):
+    """Fingerprint the contents of a set of files, so derived data
+    can tell when it has gone stale."""
+    digest = hashlib.sha1()
+    for filename in sorted(filenames):
+        digest.update(filename)
+        with open(filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def to_bytes(text):
+    """UTF-8 for unicode; byte strings, like the words read from csv, pass through."""
+    return text.encode("utf-8") if isinstance(text, unicode) else text
+
+
+class PhoneticIndex(object):
+    """The pronouncing dictionary compiled to a sorted, memory-mapped file.
+
+    Each record holds a word's pronunciations along with their stress strings
+    and rhyme tails, so none of that has to be worked out again at run time.
+    Lookups are a binary search over an offset table."""
+
+    magic = "SNTPHON1"
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self.data.find("\n")
+        magic, self.digest = self.data[:header_end].split("\t")
+        if magic != self.magic:
+            raise ValueError("{} is not a phonetic index.".format(filename))
+        self.table_start = header_end + 5
+        self.count = struct.unpack_from("<I", self.data, header_end + 1)[0]
+        self.records_start = self.table_start + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def record(self, position):
+        offset = struct.unpack_from("<I", self.data, self.table_start + 4 * position)[0]
+        start = self.records_start + offset
+        return self.data[start:self.data.find("\n", start)]
+
+    def find(self, word):
+        key = to_bytes(word)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.record(middle)
+            record_key = record[:record.find("\t")]
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def entry(self, word):
+        record = self.find(word)
+        if record is None:
+            return None
+        _, prons, syl_strings, tails = record.split("\t")
+        prons = [pron.split() for pron in prons.split("|")]
+        syl_strings = syl_strings.split("|")
+        tails = [tail.split() if tail else None for tail in tails.split("|")]
+        return prons, syl_strings, tails
+
+    @classmethod
+    def build(cls, filename, pronunciations, digest=""):
+        records = []
+        for word, prons in pronunciations.iteritems():
+            records.append("\t".join(to_bytes(field) for field in [
+                word,
+                "|".join(" ".join(pron) for pron in prons),
+                "|".join(make_syl_string(pron) for pron in prons),
+                "|".join(" ".join(last_sound(pron) or []) for pron in prons)]))
+        records.sort()
+        offsets, position = [], 0
+        for record in records:
+            offsets.append(position)
+            position += len(record) + 1
+        with open(filename, "wb") as f:
+            f.write("{}\t{}\n".format(cls.magic, digest))
+            f.write(struct.pack("<I", len(records)))
+            f.write(struct.pack("<{}I".format(len(offsets)), *offsets))
+            for record in records:
+                f.write(record)
+                f.write("\n")
+
+
+class PhoneticDictionary(object):
+    """The CMU Pronouncing Dictionary, plus any custom pronunciations.
+
+    Nothing is loaded until the first lookup. A compiled PhoneticIndex is used
+    if one has been built, otherwise the dictionary comes from nltk."""
+
+    def __init__(self, index_fn=PHONETIC_INDEX):
+        self.index_fn = index_fn
+        self.source = None
+        self.custom = {}
+
+    def load(self):
+        if os.path.exists(self.index_fn):
+            logging.info("Opening phonetic index {}...".format(self.index_fn))
+            self.source = PhoneticIndex(self.index_fn)
+            if self.source.digest != files_digest(CollectionManager().coll_file_list()):
+                logging.warning("Phonetic index is older than the collection files. Rerun build_index.py.")
+        else:
+            logging.info("Loading dictionary...")
+            self.source = nltk.corpus.cmudict.dict()
+        logging.info("Done.")
+
+    def __getitem__(self, word):
+        entry = self.entry(word)
+        if entry is None:
+            raise KeyError(word)
+        return entry[0]
+
+    def __contains__(self, word):
+        if word in self.custom:
+            return True
+        if self.source is None:
+            self.load()
+        return word in self.source
+
+    def __setitem__(self, word, prons):
+        self.custom[word] = prons
+        word_cache.discard(word)
+
+    def entry(self, word):
+        """Returns (pronunciations, stress strings, rhyme tails) for a word,
+        or None if it isn't in the dictionary."""
+        if word in self.custom:
+            prons = self.custom[word]
+        else:
+            if self.source is None:
+                self.load()
+            if isinstance(self.source, PhoneticIndex):
+                return self.source.entry(word)
+            prons = self.source.get(word)
+            if prons is None:
+                return None
+        return prons, [make_syl_string(pron) for pron in prons], [last_sound(pron) for pron in prons]
+
+
+def build_phonetic_index(filename=PHONETIC_INDEX):
+    logging.info("Loading CMU dictionary...")
+    pronunciations = nltk.corpus.cmudict.dict()
+    coll_files = CollectionManager().coll_file_list()
+    for coll_file in coll_files:
+        reader = CollectionReader(coll_file)
+        reader.read()
+        pronunciations.update(reader.pronunciations)
+    logging.info("Writing {} entries to {}...".format(len(pronunciations), filename))
+    PhoneticIndex.build(filename, pronunciations, files_digest(coll_files))
+    logging.info("Done.")
+
+
+dictionary = PhoneticDictionary()
+
+
+def split_words(text):
+    word_list = nltk.word_tokenize(text)
+    # Combine contractions
+    contractions = ["n't", "'s", "'m", "'re", "'ll", "'d"]
+    for contraction in contractions:
+        while contraction in word_list:
+            cont_index = word_list.index(contraction)
+            word_list[cont_index - 1] = "".join([word_list[cont_index - 1], contraction])
+            word_list.pop(cont_index)
+    strippable_punc = [".", ",", ":", "(", ")", ";", "?", "!", "\"", "", "''", "``", "'"]
+    return [word for word in word_list if word not in strippable_punc]
+
+
+def stress_fits(syl_string, offset, meter=IAMBIC_PENTAMETER):
+    """Checks whether a stress pattern can sit at offset in the meter.
+    "x" (a one-syllable word) fits either beat."""
+    if offset + len(syl_string) > len(meter):
+        return False
+    for char, beat in izip(syl_string, meter[offset:]):
+        if char != "x" and char != beat:
+            return False
+    return True
+
+
+def advance_offsets(offsets, syl_strings, allowed, meter=IAMBIC_PENTAMETER):
+    """Where in the meter a line can have got to after one more word,
+    keeping only the positions in allowed."""
+    return set(offset + len(syl_string) for offset in offsets for syl_string in syl_strings
+               if offset + len(syl_string) in allowed and stress_fits(syl_string, offset, meter))
+
+
+def index_by_stress(words):
+    """Groups words under every stress pattern they can be read with."""
+    index = {}
+    for word in words:
+        analysis = word_cache.get(word.lower())
+        if not analysis.not_in_dict:
+            for syl_string in analysis.variants:
+                index.setdefault(syl_string, []).append(word)
+    return index
+
+
+class Meter(object):
+    """A meter, compiled once from a foot repeated some number of times.
+
+    substitutions maps a foot's position to the other feet allowed there
+    (e.g. {0: ["su"]} for an inverted first foot), and a feminine ending
+    allows one extra unstressed syllable at the end of the line. Every
+    combination becomes a pattern, and a line scans if some reading of it
+    fits one of them, single-syllable words ("x") fitting either beat."""
+
+    def __init__(self, foot, feet, feminine_ending=False, substitutions=None):
+        self.foot = foot
+        self.feet = feet
+        self.feminine_ending = feminine_ending
+        self.substitutions = substitutions or {}
+        options = [[foot] + list(self.substitutions.get(position, [])) for position in xrange(feet)]
+        patterns = ["".join(choice) for choice in product(*options)]
+        if feminine_ending:
+            patterns.extend([pattern + "u" for pattern in patterns])
+        self.patterns = tuple(patterns)
+        self.min_length = min(len(pattern) for pattern in self.patterns)
+        self.regex = re.compile("^(?:{})$".format("|".join("".join("[ux]" if beat == "u" else "[sx]" for beat in pattern)
+                                                           for pattern in self.patterns)))
+
+    def __repr__(self):
+        return "Meter({})".format("|".join(self.patterns))
+
+    def matches(self, syl_string):
+        return self.regex.match(syl_string) is not None
+
+    def start(self):
+        return set((index, 0) for index in xrange(len(self.patterns)))
+
+    def advance(self, states, syl_strings):
+        """The (pattern, position) pairs reachable after one more word
+        read with any of syl_strings."""
+        return set((index, offset + len(syl_string)) for index, offset in states for syl_string in syl_strings
+                   if stress_fits(syl_string, offset, self.patterns[index]))
+
+    def accepts(self, states):
+        return any(offset == len(self.patterns[index]) for index, offset in states)
+
+
+iambic_pentameter = Meter("us", 5)
+iambic_tetrameter = Meter("us", 4)
+trochaic_tetrameter = Meter("su", 4)
+# The pentameter most sonnets are actually written in
+loose_iambic_pentameter = Meter("us", 5, feminine_ending=True, substitutions={0: ["su"]})
+
+
+class WordAnalysis(object):
+    """What the pronouncing dictionary says about one word, worked out once.
+
+    Records are shared by every Word with the same text, so they are
+    read-only."""
+
+    __slots__ = ("text", "not_in_dict", "multi_prons", "pron", "multi_syls", "syl_string", "syllables",
+                 "variants", "last_sounds", "rhyme_keys")
+
+    def __init__(self, text):
+        fields = {"text": text}
+        entry = dictionary.entry(text)
+        if entry is None:
+            logging.warning("Word \'{}\' not found in CMU dictionary.".format(text))
+            fields["not_in_dict"] = True
+            fields["variants"] = ()
+            fields["rhyme_keys"] = frozenset()
+        else:
+            prons, syl_strings, last_sounds = entry
+            fields["not_in_dict"] = False
+            fields["multi_prons"] = len(prons) > 1
+            # Stored as tuples, since every Word sharing the record sees them
+            prons = tuple(tuple(pron) for pron in prons)
+            fields["pron"] = prons if len(prons) > 1 else prons[0]
+            fields["multi_syls"] = any(syl_string != syl_strings[0] for syl_string in syl_strings)
+            if not fields["multi_syls"]:
+                fields["syl_string"] = syl_strings[0]
+                fields["syllables"] = len(syl_strings[0])
+            else:
+                fields["syl_string"] = tuple(set(syl_strings))
+                fields["syllables"] = tuple(len(syl_string) for syl_string in fields["syl_string"])
+            fields["variants"] = tuple(sorted(set(syl_strings)))
+            if len(prons) > 1:
+                # Some words have totally unstressed pronunciations, which leads them returning "None" for last sound
+                # Then, if you get two, you get incorrect rhymes as None matches None.
+                # Have to filter them out.
+                last_sounds = [sound for sound in last_sounds if sound is not None]
+            fields["last_sounds"] = tuple(tuple(sound) if sound is not None else None for sound in last_sounds)
+            fields["rhyme_keys"] = frozenset(rhyme_key(sound) for sound in last_sounds if sound is not None)
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("WordAnalysis records are read-only.")
+
+    def __repr__(self):
+        return "WordAnalysis({})".format(self.text)
+
+    def __reduce__(self):
+        # Unpickled records are looked up again, so they stay shared
+        return analyze, (self.text,)
+
+
+class WordCache(object):
+    """Hands out one shared WordAnalysis per word, keeping at most
+    maxsize of them and evicting the least recently used."""
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, text):
+        with self.lock:
+            try:
+                analysis = self.records.pop(text)
+                self.hits += 1
+            except KeyError:
+                analysis = WordAnalysis(text)
+                self.misses += 1
+                if len(self.records) >= self.maxsize:
+                    self.records.popitem(last=False)
+                    self.evictions += 1
+            self.records[text] = analysis
+            return analysis
+
+    def discard(self, text):
+        with self.lock:
+            self.records.pop(text, None)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.records),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+word_cache = WordCache()
+
+
+def analyze(text):
+    return word_cache.get(text)
+
+
 class Word(object):
     """A word: a poem's elemental cell.
     Count syllables. Find stresses. Do it well."""
@@ -67,97 +494,39 @@ class Word(object):
         self.syl_count()
 
     def look_up(self):
-        try:
-            pronunciations = dictionary[self.text]
-        except KeyError:
-            self.not_in_dict = True
-            logging.warning("Word \'{}\' not found in CMU dictionary.".format(self.text))
+        self.analysis = word_cache.get(self.text)
+        self.not_in_dict = self.analysis.not_in_dict
+        if self.not_in_dict:
             return
-        self.not_in_dict = False
-        if len(pronunciations) > 1:
-            self.multi_prons = True
-            self.pron = pronunciations
-        else:
-            self.multi_prons = False
-            self.pron = pronunciations[0]
+        self.multi_prons = self.analysis.multi_prons
+        self.pron = self.analysis.pron
 
     def make_syl_string(self, pron):
-        syl_string = []
-        for symbol in pron:
-            if "0" in symbol:
-                syl_string.append(0)
-            elif "1" in symbol:
-                syl_string.append(1)
-            elif "2" in symbol:
-                syl_string.append(2)
-        return self.stresses(syl_string)
+        return make_syl_string(pron)
 
     def syl_count(self):
-        self.multi_syls = False
-        if not self.multi_prons:
-            self.syl_string = self.make_syl_string(self.pron)
-            self.syllables = len(self.syl_string)
-        else:
-            syl_strings = [self.make_syl_string(pron) for pron in self.pron]
-            for syl_string in syl_strings:
-                if syl_string != syl_strings[0]:
-                    self.multi_syls = True
-            if not self.multi_syls:
-                self.syl_string = syl_strings[0]
-                self.syllables = len(self.syl_string)
-            else:
-                self.syl_string = list(set(syl_strings))
-                self.syllables = [len(syl_string) for syl_string in self.syl_string]
+        self.multi_syls = self.analysis.multi_syls
+        self.syl_string = self.analysis.syl_string
+        self.syllables = self.analysis.syllables
 
     def stresses(self, syl_string):
-        stresses = []
-        if len(syl_string) == 1:
-            stresses.append("x")
-        else:
-            previous_syls, syls, next_syls = tee(syl_string, 3)
-            next_syls = chain(islice(next_syls, 1, None), [None])
-            previous_syls = chain([None], previous_syls)
-            linked_syls = izip(previous_syls, syls, next_syls)
-            for prev, syl, next in linked_syls:
-                if syl == 1:
-                    stresses.append("s")
-                elif syl == 2:
-                    # For secondary stress, it's unstressed if next to a primary stress
-                    # and stressed otherwise
-                    if next == 1 or prev == 1:
-                        stresses.append("u")
-                    else:
-                        stresses.append("s")
-                else:
-                    stresses.append("u")
-        return "".join(stresses)
+        return stresses(syl_string)
 
     def last_sound(self, pron):
-        for index, sound in enumerate(reversed(pron)):
-            if stressed_syllable_marks.search(sound):
-                return [sound.strip("012") for sound in pron[-(index + 1):]]
+        return last_sound(pron)
 
     def find_last_sounds(self):
-        self.last_sounds = []
-        if not self.multi_prons:
-            self.last_sounds.append(self.last_sound(self.pron))
-        else:
-            self.last_sounds = [self.last_sound(pron) for pron in self.pron if self.last_sound(pron) is not None]
-            # Some words have totally unstressed pronunciations, which leads them returning "None" for last sound
-            # Then, if you get two, you get incorrect rhymes as None matches None.
-            # Have to filter them out.
+        self.last_sounds = self.analysis.last_sounds
+
+    def rhyme_keys(self):
+        return self.analysis.rhyme_keys
 
     def rhymes_with(self, other_word):
         if other_word.text == self.text:
             return False
         # Prevent "rhyming" the same word.
-        self.find_last_sounds()
-        other_word.find_last_sounds()
-        for other_sound in other_word.last_sounds:
-            for this_sound in self.last_sounds:
-                if this_sound == other_sound or self.slant_rhyme(this_sound, other_sound):
-                    return True
-        return False
+        # Slant rhymes share a rhyme key with exact ones, so one set intersection covers both.
+        return bool(self.rhyme_keys() & other_word.rhyme_keys())
 
     def slant_rhyme(self, sound1, sound2):
         if len(sound1) == len(sound2):
@@ -182,70 +551,94 @@ class Line(object):
     """Does it scan? Does it rhyme? A line's
     what happens when some Words combine."""
 
-    def __init__(self, text):
+    _syl_strings = None
+
+    def __init__(self, text, words=None):
         self.text = text
-        self.make_word_list()
-        self.make_syl_strings()
+        if words is None:
+            self.make_word_list()
+        else:
+            self.word_list = [Word(word) for word in words]
         self.choices = []
 
     def __repr__(self):
         return "Line({})".format(self.text)
 
+    @classmethod
+    def restore(cls, text, choices):
+        """Recreates a saved Line's text and choices without analysing its words."""
+        line = cls.__new__(cls)
+        line.text = text
+        line.choices = choices
+        return line
+
+    @classmethod
+    def from_template(cls, template, choices):
+        """Builds the Line for a filled-in template from the template's
+        own tokens, so only free text has to go through the tokenizer."""
+        text = template.compiled.format(choices)
+        if template.compiled.attached:
+            line = cls(text)
+            line.choices = choices
+            return line
+        words = []
+        for blank_index, token in template.tokens():
+            if blank_index is None:
+                words.append(token)
+                continue
+            choice = choices[blank_index].strip()
+            if not choice.isalpha():
+                if choice or token:
+                    # Punctuation, spaces or a dangling suffix: let the tokenizer sort it out
+                    words = None
+                    break
+                continue
+            words.append(choice + token)
+        line = cls(text, words)
+        line.choices = choices
+        return line
+
     def make_word_list(self):
-        word_list = nltk.word_tokenize(self.text)
-        # Combine contractions
-        contractions = ["n't", "'s", "'m", "'re", "'ll", "'d"]
-        for contraction in contractions:
-            while contraction in word_list:
-                cont_index = word_list.index(contraction)
-                word_list[cont_index - 1] = "".join([word_list[cont_index - 1], contraction])
-                word_list.pop(cont_index)
-        strippable_punc = [".", ",", ":", "(", ")", ";", "?", "!", "\"", "", "''", "``", "'"]
-        word_list = [word for word in word_list if word not in strippable_punc]
-        self.word_list = [Word(word) for word in word_list]
+        self.word_list = [Word(word) for word in split_words(self.text)]
+
+    @property
+    def syl_strings(self):
+        # Only listed out when asked for: there's one per combination of
+        # pronunciations, and scans() and too_short() don't need them.
+        if self._syl_strings is None:
+            self.make_syl_strings()
+        return self._syl_strings
+
+    @syl_strings.setter
+    def syl_strings(self, syl_strings):
+        self._syl_strings = syl_strings
 
     def make_syl_strings(self):
-        syl_strings = [[]]
+        # For each possible pronunciation of each word, a syllable string
+        self._syl_strings = ["".join(string) for string in product(*[word.analysis.variants
+                                                                     for word in self.word_list])]
+
+    def too_short(self, meter=iambic_pentameter):
+        if self._syl_strings is not None:
+            return all(len(syl_string) < meter.min_length for syl_string in self._syl_strings)
+        longest = 0
         for word in self.word_list:
-            if not word.multi_syls:
-                for line_string in syl_strings:
-                    line_string.append(word.syl_string)
-            else:
-                new_syl_strings = []
-                for line_string in syl_strings:
-                    for word_string in word.syl_string:
-                        new_syl_strings.append(line_string + [word_string])
-                syl_strings = new_syl_strings
-                # For each possible pronunciation, create a syllable string
-                # with that pronunciation added to the end
-        joined_strings = ["".join(string) for string in syl_strings]
-        self.syl_strings = joined_strings
-
-    def too_short(self):
-        for syl_string in self.syl_strings:
-            if len(syl_string) >= 10:
+            if not word.analysis.variants:
+                return True
+            longest += max(len(syl_string) for syl_string in word.analysis.variants)
+        return longest < meter.min_length
+
+    def scans(self, meter=iambic_pentameter):
+        if self._syl_strings is not None:
+            return any(meter.matches(syl_string) for syl_string in self._syl_strings)
+        # Walk the meter a word at a time, keeping each position some reading of
+        # the line so far could reach, and give up as soon as there are none.
+        states = meter.start()
+        for word in self.word_list:
+            states = meter.advance(states, word.analysis.variants)
+            if not states:
                 return False
-        return True
-
-    def scans(self):
-        results = []
-        for syl_string in self.syl_strings:
-            result = True
-            if not len(syl_string) == 10:
-                result = False
-            else:
-                for position, char in enumerate(syl_string):
-                    if position % 2 == 0:
-                        if char == "s":
-                            result = False
-                    else:
-                        if char == "u":
-                            result = False
-            results.append(result)
-        if True in results:
-            return True
-        else:
-            return False
+        return meter.accepts(states)
 
     def rhymes_with(self, other_line):
         if self.word_list[-1].rhymes_with(other_line.word_list[-1]):
@@ -253,11 +646,13 @@ class Line(object):
         else:
             return False
 
+    def rhyme_keys(self):
+        return self.word_list[-1].rhyme_keys()
+
     def same_choices(self, other_line):
-        for choice in self.choices:
-            if choice in other_line.choices and choice != "":
-                return True
-        return False
+        shared = set(self.choices).intersection(other_line.choices)
+        shared.discard("")
+        return bool(shared)
 
     def capitalize_first_word(self):
         words = self.text.split()
@@ -274,12 +669,16 @@ class Line(object):
         self.text = self.text.rstrip(",")
         self.text = "".join([self.text, "."])
 
+    def chosen_words(self):
+        """The words filling the blanks, without the space after optional ones."""
+        return [choice.strip() for choice in self.choices if choice]
+
     def no_repeated_choices(self):
         seen = set()
-        for choice in self.choices:
-            if choice != "" and choice in seen:
+        for word in self.chosen_words():
+            if word in seen:
                 return False
-            seen.add(choice)
+            seen.add(word)
         return True
 
     def change_a_to_an(self):
@@ -297,11 +696,91 @@ class Line(object):
                             self.text = " ".join(all_words)
 
 
+class CompiledTemplate(object):
+    """Everything about a template's text that never changes, worked out
+    once: the literal text between the blanks, the tokens, the stress
+    patterns of the fixed words, which blanks are optional and whether
+    the line ends on a blank.
+
+    Shared by whatever is filling the template, so it's read-only."""
+
+    __slots__ = ("raw_text", "optional", "segments", "tokens", "fixed_variants", "required_blanks",
+                 "optional_blanks", "flexible", "attached")
+
+    def __init__(self, raw_text, optional):
+        fields = {"raw_text": raw_text, "optional": tuple(optional)}
+        fields["segments"] = self.split_segments(raw_text, len(optional))
+        # Marks are spaced like the choices: optional words carry the space after them
+        marks = [BLANK_MARK.format(index) + (" " if flag else "") for index, flag in enumerate(optional)]
+        tokens = []
+        fields["attached"] = False
+        for word in split_words(raw_text.format(*marks)):
+            mark = blank_marks.match(word)
+            if mark and not any_blank_mark.search(mark.group(2)):
+                tokens.append((int(mark.group(1)), mark.group(2)))
+            else:
+                if any_blank_mark.search(word):
+                    # Text before a blank or between two ("un{}", "{}-{}") makes one word with
+                    # the choices, and only the tokenizer can say what that is
+                    fields["attached"] = True
+                tokens.append((None, word))
+        fields["tokens"] = tokens
+        fields["fixed_variants"] = tuple(None if blank_index is not None or any_blank_mark.search(text)
+                                         else word_cache.get(text.lower()).variants
+                                         for blank_index, text in tokens)
+        fields["required_blanks"] = tuple(index for index, flag in enumerate(optional) if not flag)
+        fields["optional_blanks"] = tuple(index for index, flag in enumerate(optional) if flag)
+        # Checks to see if there is a word after the last blank
+        fields["flexible"] = not any(c.isalpha() for c in raw_text.split("{}")[-1])
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    @staticmethod
+    def split_segments(raw_text, blank_count):
+        """The literal text around each blank, or None if the template uses
+        more of str.format than plain {} fields and has to go through it."""
+        segments = [""]
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(raw_text):
+            # Escaped braces come back as literals of their own, so they're joined up again
+            segments[-1] += literal
+            if field_name is None:
+                continue
+            if field_name or format_spec or conversion:
+                return None
+            segments.append("")
+        if len(segments) - 1 > blank_count:
+            return None
+        return tuple(segments)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledTemplate records are read-only.")
+
+    def __repr__(self):
+        return "CompiledTemplate({})".format(self.raw_text)
+
+    def __reduce__(self):
+        return CompiledTemplate, (self.raw_text, self.optional)
+
+    def format(self, choices):
+        if self.segments is None:
+            return self.raw_text.format(*choices)
+        parts = [self.segments[0]]
+        for choice, segment in izip(choices, self.segments[1:]):
+            parts.append(choice)
+            parts.append(segment)
+        text = "".join(parts)
+        # str.format gives back a str even when the choices are unicode
+        return text if isinstance(self.raw_text, unicode) else str(text)
+
+
 class Template(object):
     """A Template for a Line we hope to fill
     with some convincing fakery of skill."""
 
-    def __init__(self, raw_text, blanks, intro_required=False, outro_required=False, intro=False, outro=False):
+    _compiled = None
+
+    def __init__(self, raw_text, blanks, intro_required=False, outro_required=False, intro=False, outro=False,
+                 compiled=None):
         self.raw_text = raw_text
         self.blanks = blanks
         self.intro = intro
@@ -311,37 +790,125 @@ class Template(object):
         self.filled_line = None
         self.sentence_start = False
         self.sentence_end = False
+        self.id = None
+        self._compiled = compiled
 
     def __repr__(self):
         return "Template({})".format(self.raw_text)
 
-    def populate(self):
+    def __getstate__(self):
+        # Candidates are rebuilt for every poem, so there's no need to carry them around
+        state = self.__dict__.copy()
+        state["candidates"] = []
+        return state
+
+    @property
+    def compiled(self):
+        # Templates read from a file come compiled; others are compiled when first filled
+        if self._compiled is None:
+            self._compiled = CompiledTemplate(self.raw_text, [blank.optional for blank in self.blanks])
+        return self._compiled
+
+    def tokens(self):
+        """The template's words as (blank index, text) pairs, tokenized once.
+        Fixed words have a blank index of None; a blank's text is whatever
+        gets attached to the chosen word, like "'s"."""
+        return self.compiled.tokens
+
+    def populate(self, rng=random, meter=iambic_pentameter):
+        compiled = self.compiled
         choices = ["" for _ in self.blanks]
-        unfilled_optionals = [blank for blank in self.blanks if blank.optional]
-        for index, blank in enumerate(self.blanks):
-            if not blank.optional:
-                choices[index] = blank.fill()
+        unfilled_optionals = list(compiled.optional_blanks)
+        for index in compiled.required_blanks:
+            choices[index] = self.blanks[index].fill(rng)
         candidate = self.make_line(choices)
-        while candidate.too_short() and unfilled_optionals:
-            next_optional_blank = random.choice(unfilled_optionals)
-            unfilled_optionals.remove(next_optional_blank)
-            optional_word = "{} ".format(next_optional_blank.fill())
+        while candidate.too_short(meter) and unfilled_optionals:
+            index = rng.choice(unfilled_optionals)
+            unfilled_optionals.remove(index)
             # Needed to insert space between optional word and next word.
-            choices[self.blanks.index(next_optional_blank)] = optional_word
+            choices[index] = "{} ".format(self.blanks[index].fill(rng))
             candidate = self.make_line(choices)
         return candidate
 
     def make_line(self, choices):
-        line = Line(self.raw_text.format(*choices))
-        line.choices = choices
-        return line
+        return Line.from_template(self, choices)
 
-    def make_scanning_line(self, attempts=10000):
+    def guided_populate(self, feasible, meter=IAMBIC_PENTAMETER, rng=random):
+        """Fills the blanks left to right, only ever choosing words whose
+        stresses fit the next beats and leave the rest of the line fillable.
+        Returns None if it paints itself into a corner."""
+        fixed_variants = self.compiled.fixed_variants
+        choices = ["" for _ in self.blanks]
+        offsets = set([0])
+        for position, (blank_index, text) in enumerate(self.tokens()):
+            ahead = feasible[position + 1]
+            if blank_index is None:
+                offsets = advance_offsets(offsets, fixed_variants[position], ahead, meter)
+            else:
+                blank = self.blanks[blank_index]
+                # An optional word is left out half the time, when the line can scan without it
+                skippable = blank.optional and offsets & ahead
+                word = None
+                if not skippable or rng.random() < 0.5:
+                    word = blank.fill_to_fit(lambda syl_string: advance_offsets(offsets, [syl_string], ahead, meter),
+                                             exclude=[choice.strip() for choice in choices], rng=rng)
+                if word is None:
+                    if not skippable:
+                        return None
+                    offsets &= ahead
+                    continue
+                offsets = advance_offsets(offsets, word_cache.get(word.lower()).variants, ahead, meter)
+                choices[blank_index] = "{} ".format(word) if blank.optional else word
+                # Optional words carry the space between them and the next word.
+            if not offsets:
+                return None
+        return self.make_line(choices)
+
+    def feasible_offsets(self, meter=IAMBIC_PENTAMETER):
+        """For each token, the positions in the meter it could start at
+        and still have the rest of the line finish on the last beat."""
+        tokens = self.tokens()
+        fixed_variants = self.compiled.fixed_variants
+        feasible = [set() for _ in xrange(len(tokens) + 1)]
+        feasible[-1] = set([len(meter)])
+        for position in reversed(xrange(len(tokens))):
+            blank_index, text = tokens[position]
+            if blank_index is None:
+                syl_strings = fixed_variants[position]
+            else:
+                syl_strings = self.blanks[blank_index].stress_patterns()
+            feasible[position] = set(offset for offset in xrange(len(meter) + 1)
+                                     if advance_offsets([offset], syl_strings, feasible[position + 1], meter))
+        return feasible
+
+    def make_guided_line(self, attempts=100, rng=random, meter=iambic_pentameter):
+        # Each of the meter's patterns is walked separately; only the ones the template can fit are tried.
+        feasible = [(pattern, self.feasible_offsets(pattern)) for pattern in meter.patterns]
+        feasible = [(pattern, offsets) for pattern, offsets in feasible if 0 in offsets[0]]
+        if not feasible:
+            msg = "No scanning completions possible for template: {}".format(self.raw_text)
+            raise ScanFailure(self, msg)
+        for _ in xrange(attempts):
+            pattern, offsets = feasible[0] if len(feasible) == 1 else rng.choice(feasible)
+            candidate = self.guided_populate(offsets, pattern, rng=rng)
+            # Words fused to the template text (like "'s") can still upset the meter
+            if candidate and candidate.scans(meter) and candidate.no_repeated_choices():
+                return candidate
+        msg = "No scanning completions found for template: {}".format(self.raw_text)
+        raise ScanFailure(self, msg)
+
+    def make_scanning_line(self, attempts=None, guided=True, rng=random, meter=iambic_pentameter):
+        """Fills the template until a line scans. attempts defaults to 100
+        for guided filling, 10000 for random."""
+        # The guided walk needs every blank to be a word of its own
+        if guided and not self.compiled.attached:
+            return self.make_guided_line(attempts=attempts or 100, rng=rng, meter=meter)
+        attempts = attempts or 10000
         finished = False
         fail_count = 0
         while not finished:
-            candidate = self.populate()
-            if candidate.scans() and candidate.no_repeated_choices():
+            candidate = self.populate(rng, meter)
+            if candidate.scans(meter) and candidate.no_repeated_choices():
                 return candidate
             else:
                 fail_count += 1
@@ -349,8 +916,8 @@ class Template(object):
                 msg = "No scanning completions found for template: {}".format(self.raw_text)
                 raise ScanFailure(self, msg)
 
-    def make_candidates(self, depth=20):
-        self.candidates = [self.make_scanning_line() for _ in xrange(depth)]
+    def make_candidates(self, depth=20, guided=True, rng=random, meter=iambic_pentameter):
+        self.candidates = [self.make_scanning_line(guided=guided, rng=rng, meter=meter) for _ in xrange(depth)]
 
     def convert_to_rhyme(self, words):
         self.blanks[-1] = RhymeBlank(self.blanks[-1].pos_tag, words, self.blanks[-1].optional)
@@ -359,12 +926,10 @@ class Template(object):
         self.blanks[-1] = Blank(self.blanks[-1].pos_tag, self.blanks[-1].optional)
 
     def is_flexible(self):
-        return not any(c.isalpha() for c in self.raw_text.split("{}")[-1])
-        # Convoluted, but checks to see if there is a word after the last blank
-        # (Split on the blanks, grab the last section, see if there are any letters in it)
+        return self.compiled.flexible
 
     def last_words(self):
-        last_words = set([cand.word_list[-1].text for cand in self.candidates])
+        last_words = sorted(set([cand.word_list[-1].text for cand in self.candidates]))
         last_words = [Word(text) for text in last_words]
         return last_words
 
@@ -381,9 +946,12 @@ class Template(object):
         if self.sentence_end and last_char not in sentence_ending_punc:
             self.filled_line.end_with_period()
 
-    def cleanup(self):
+    def unfill(self):
         self.candidates = []
         self.filled_line = None
+
+    def cleanup(self):
+        self.unfill()
         self.sentence_start = False
         self.sentence_end = False
 
@@ -398,7 +966,7 @@ class TemplateReader(object):
         templates = []
         with open(self.filename, "r") as f:
             reader = csv.DictReader(f)
-            for row in reader:
+            for index, row in enumerate(reader):
                 tags = row["pos_tags"].split()
                 optional_flags = row["optional"].split()
                 intro = self.translate_tags(row["intro"])
@@ -406,10 +974,12 @@ class TemplateReader(object):
                 intro_required = self.translate_tags(row["intro_required"])
                 outro_required = self.translate_tags(row["outro_required"])
                 blanks = [Blank(tag, optional=(opt_flag == "T")) for tag, opt_flag in zip(tags, optional_flags)]
-                templates.append(
-                    Template(row["raw_text"], blanks, intro=intro, outro=outro, intro_required=intro_required,
-                             outro_required=outro_required))
-        return templates
+                compiled = CompiledTemplate(row["raw_text"], [blank.optional for blank in blanks])
+                template = Template(row["raw_text"], blanks, intro=intro, outro=outro, intro_required=intro_required,
+                                    outro_required=outro_required, compiled=compiled)
+                template.id = index
+                templates.append(template)
+        return TemplatePool(templates)
 
     def translate_tags(self, tag):
         if tag == "F":
@@ -418,6 +988,67 @@ class TemplateReader(object):
             return tag
 
 
+class TemplatePool(list):
+    """A list of Templates, indexed by the labels sentences are joined on.
+
+    by_outro[label] holds the templates that can come before one whose
+    intro_required is label, by_intro[label] those that can come after one
+    whose outro_required is label, both in pool order. The indexes are
+    built once, so the pool shouldn't be changed afterwards."""
+
+    def __init__(self, templates=()):
+        super(TemplatePool, self).__init__(templates)
+        self.by_intro, self.by_outro = {}, {}
+        for template in self:
+            self.by_intro.setdefault(template.intro, []).append(template)
+            self.by_outro.setdefault(template.outro, []).append(template)
+        self.length_catalogs = {}
+
+    def preceding(self, template):
+        if not template.intro_required:
+            return []
+        return self.by_outro.get(template.intro_required, [])
+
+    def following(self, template):
+        if not template.outro_required:
+            return []
+        return self.by_intro.get(template.outro_required, [])
+
+    def sentence_lengths(self, max_length):
+        """For each template, the lengths of the sentences match_transitions
+        could build around it, up to max_length lines. Worked out once per
+        max_length by following the labels, ignoring which templates are
+        already used, so a length here is possible rather than certain."""
+        if max_length not in self.length_catalogs:
+            before, after = {}, {}
+            catalog = {}
+            for template in self:
+                intros = self.chain_lengths(template.intro_required, max_length - 1, self.by_outro,
+                                            "intro_required", before)
+                outros = self.chain_lengths(template.outro_required, max_length - 1, self.by_intro,
+                                            "outro_required", after)
+                catalog[template] = frozenset(1 + intro + outro for intro in intros for outro in outros
+                                              if 1 + intro + outro <= max_length)
+            self.length_catalogs[max_length] = catalog
+        return self.length_catalogs[max_length]
+
+    def chain_lengths(self, label, budget, index, requirement, memo):
+        """The lengths of the chains, at most budget long, that satisfy a
+        required label: each template in the chain has the label the one
+        before it requires, and the last requires nothing more."""
+        if not label:
+            return frozenset([0])
+        key = (label, budget)
+        if key not in memo:
+            lengths = set()
+            if budget > 0:
+                for next_label in set(getattr(template, requirement) for template in index.get(label, [])):
+                    lengths.update(1 + length for length in
+                                   self.chain_lengths(next_label, budget - 1, index, requirement, memo))
+            memo[key] = frozenset(lengths)
+        return memo[key]
+
+
 class Blank(object):
     """docstring for Blank"""
 
@@ -426,17 +1057,64 @@ class Blank(object):
         self.optional = optional
         self.collection_pool = []
         self.collection_prob = collection_prob
-
-    def fill(self):
+        self.stress_pools = None
+
+    def __getstate__(self):
+        # Pools are rebuilt for every poem, so there's no need to carry them around
+        state = self.__dict__.copy()
+        for pool in ["common_pool", "collection_pool", "rhyme_pool"]:
+            if pool in state:
+                state[pool] = []
+        state["stress_pools"] = None
+        return state
+
+    def fill(self, rng=random):
         if self.collection_pool:
-            use_collection = random.random()
+            use_collection = rng.random()
             if use_collection < self.collection_prob:
-                return random.choice(self.collection_pool)
-        return random.choice(self.common_pool)
+                return rng.choice(self.collection_pool)
+        return rng.choice(self.common_pool)
 
     def make_pools(self, vocab):
         self.common_pool = vocab.make_common_pool(self.pos_tag)
         self.collection_pool = vocab.make_collection_pool(self.pos_tag)
+        self.stress_pools = [vocab.stress_pool("collection", self.pos_tag), vocab.stress_pool("common", self.pos_tag)]
+
+    def stress_index(self):
+        """The collection and common pools, each indexed by stress pattern.
+        Normally shared from the vocab; indexed here if the pools were set by hand."""
+        if self.stress_pools is None:
+            self.stress_pools = [index_by_stress(self.collection_pool), index_by_stress(self.common_pool)]
+        return self.stress_pools
+
+    def preferred_pools(self, rng=random):
+        pools = self.stress_index()
+        if pools[0] and rng.random() < self.collection_prob:
+            return pools
+        return pools[::-1]
+
+    def stress_patterns(self):
+        patterns = set(pattern for pool in self.stress_index() for pattern in pool)
+        if self.optional:
+            patterns.add("")
+        return patterns
+
+    def fill_to_fit(self, fits, exclude=(), rng=random):
+        """Like fill, but only draws words with a stress pattern that fits accepts."""
+        for pool in self.preferred_pools(rng):
+            buckets = [bucket for pattern, bucket in pool.iteritems() if fits(pattern)]
+            total = sum(len(bucket) for bucket in buckets)
+            if not total:
+                continue
+            for _ in xrange(len(exclude) + 1):
+                pick = rng.randrange(total)
+                for bucket in buckets:
+                    if pick < len(bucket):
+                        break
+                    pick -= len(bucket)
+                if bucket[pick] not in exclude:
+                    return bucket[pick]
+        return None
 
 
 class RhymeBlank(Blank):
@@ -445,11 +1123,20 @@ class RhymeBlank(Blank):
         self.words = words
         self.rhyme_pool = []
 
-    def fill(self):
-        return random.choice(self.rhyme_pool)
+    def fill(self, rng=random):
+        return rng.choice(self.rhyme_pool)
+
+    def stress_index(self):
+        if self.stress_pools is None:
+            self.stress_pools = [index_by_stress(self.rhyme_pool)]
+        return self.stress_pools
+
+    def preferred_pools(self, rng=random):
+        return self.stress_index()
 
     def make_pools(self, vocab):
         self.rhyme_pool = vocab.make_rhyme_pool(self.words, self.pos_tag)
+        self.stress_pools = None
         if not self.rhyme_pool:
             msg = "Unable to find rhymes in {} for {}".format(self.pos_tag, [word.text for word in self.words])
             raise RhymeFailure(self, msg)
@@ -458,6 +1145,7 @@ class RhymeBlank(Blank):
 class CollectionReader(object):
     def __init__(self, coll_file):
         self.coll_file = coll_file
+        self.pronunciations = {}
 
     def read(self):
         tagged_words = []
@@ -469,7 +1157,8 @@ class CollectionReader(object):
                 pron = row["pron"]
                 tagged_words.append((word, pos_tag))
                 if pron:
-                    dictionary[word.lower()] = [pron]
+                    self.pronunciations[word.lower()] = [pron.split()]
+                    dictionary[word.lower()] = [pron.split()]
         return tagged_words
 
 
@@ -496,6 +1185,116 @@ class Collection(object):
         maxes = sorted(similarities)[:depth]
         return maxes
 
+def hypernym_distances(synset):
+    """The fewest steps up from a synset to each of its hypernyms, itself
+    included, by name. The same walk path_similarity makes."""
+    distances = {}
+    queue = [(synset, 0)]
+    for current, distance in queue:
+        if current.name() in distances:
+            continue
+        distances[current.name()] = distance
+        queue.extend((hypernym, distance + 1) for hypernym in current.hypernyms())
+        queue.extend((hypernym, distance + 1) for hypernym in current.instance_hypernyms())
+    return distances
+
+
+class SimilarityIndex(object):
+    """The WordNet senses of every collection's words, with their hypernyms,
+    worked out once and saved, so a prompt can be matched against all the
+    collections without walking the WordNet graph for each of their senses.
+
+    Gives the same scores as Collection.max_similarities: a sense's path
+    similarity comes from the closest hypernym it shares with the prompt's,
+    or from a simulated root when the prompt's sense is one that needs it."""
+
+    version = 1
+
+    def __init__(self, senses, max_depths, holders, collection_senses):
+        # Sense names, and the steps from each sense to its highest hypernym
+        self.senses = senses
+        self.max_depths = max_depths
+        # Hypernym name -> [(sense index, steps up to it)]
+        self.holders = holders
+        # Collection id -> [(sense index, how many of its words have that sense)]
+        self.collection_senses = collection_senses
+
+    @classmethod
+    def build(cls, collections):
+        logging.info("Indexing WordNet senses for {} collections...".format(len(collections)))
+        positions, senses, max_depths, holders = {}, [], [], {}
+        collection_senses = {}
+        for collection_id, collection in collections.items():
+            counts = OrderedDict()
+            for word in collection.words:
+                for synset in wn.synsets(word):
+                    if synset.name() not in positions:
+                        positions[synset.name()] = len(senses)
+                        distances = hypernym_distances(synset)
+                        senses.append(synset.name())
+                        max_depths.append(max(distances.values()))
+                        for hypernym, distance in distances.items():
+                            holders.setdefault(hypernym, []).append((positions[synset.name()], distance))
+                    index = positions[synset.name()]
+                    counts[index] = counts.get(index, 0) + 1
+            collection_senses[collection_id] = counts.items()
+        logging.info("Done.")
+        return cls(senses, max_depths, holders, collection_senses)
+
+    @staticmethod
+    def key(coll_files):
+        return SimilarityIndex.version, wn.get_version(), files_digest(coll_files)
+
+    def save(self, path, key):
+        with open(path, "wb") as f:
+            pickle.dump({"key": key,
+                         "senses": self.senses,
+                         "max_depths": self.max_depths,
+                         "holders": self.holders,
+                         "collection_senses": self.collection_senses}, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, key):
+        """The saved index, or None if it's missing or stale."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if saved["key"] != key:
+            logging.warning("Similarity index {} is stale.".format(path))
+            return None
+        return cls(saved["senses"], saved["max_depths"], saved["holders"], saved["collection_senses"])
+
+    def distances(self, synset):
+        """The shortest path from synset to every indexed sense, None where there's none."""
+        distances = [None] * len(self.senses)
+        own = hypernym_distances(synset)
+        for hypernym, up in own.items():
+            for index, down in self.holders.get(hypernym, ()):
+                if distances[index] is None or up + down < distances[index]:
+                    distances[index] = up + down
+        # path_similarity only simulates a root if the synset it's called on needs one
+        if synset._needs_root():
+            top = max(own.values()) + 1
+            for index, depth in enumerate(self.max_depths):
+                through_root = top + depth + 1
+                if distances[index] is None or through_root < distances[index]:
+                    distances[index] = through_root
+        return distances
+
+    def max_similarities(self, synset, depth):
+        """Collection id -> what that collection's max_similarities would give."""
+        distances = self.distances(synset)
+        results = {}
+        for collection_id, senses in self.collection_senses.items():
+            similarities = []
+            for index, count in senses:
+                if distances[index] is not None:
+                    similarities.extend([1.0 / (distances[index] + 1)] * count)
+            results[collection_id] = sorted(similarities)[:depth]
+        return results
+
+
 class CollectionManager(object):
     def __init__(self):
         self.collections = {}
@@ -518,45 +1317,123 @@ class Vocab(object):
     words for each part of speech, and stores the results so
     the slow lookup only happens once."""
 
-    def __init__(self, common_depth=1500, uncommon_depth=20000):
+    snapshot_version = 1
+
+    def __init__(self, common_depth=1500, uncommon_depth=20000, seed=None, rng=None):
         logging.info("Initializing vocabulary...")
-        logging.info("Loading Brown corpus...")
-        self.corpus = nltk.corpus.brown.tagged_words()
-        logging.info("Done.")
-        logging.info("Making frequency distribution...")
-        self.cfd = nltk.ConditionalFreqDist((tag, word) for word, tag in self.corpus)
-        logging.info("Done.")
+        self.rng = rng if rng is not None else random.Random(seed)
+        self._cfd = None
         logging.info("Loading collections...")
         cm = CollectionManager()
         cm.read_all()
         self.collections = cm.collections
+        self.coll_files = cm.coll_file_list()
+        self._similarity_index = None
         logging.info("Done")
 
         self.common_depth = common_depth
         self.uncommon_depth = uncommon_depth
         self.common_tag_words = {}
         self.collection_pool = {}
+        self.collections_in_use = []
         self.uncommon_tag_words = {}
-        self.used = []
-        self.blacklist = []
+        self.rhyme_index = {}
+        self.complete = False
+        self.used = set()
+        self.live_pools = {}
+        self.stress_pools = {}
+        self.pool_index = {}
+        # For each used word, the live pools it was taken out of (or left out of)
+        self.used_pools = {}
+        self.blacklist = set()
         logging.info("Initializing blacklist...")
         self.read_blacklist()
         logging.info("Done.")
 
+    @classmethod
+    def from_snapshot(cls, path=VOCAB_SNAPSHOT, common_depth=1500, uncommon_depth=20000, rebuild=True, seed=None,
+                      rng=None):
+        """Makes a Vocab from a snapshot written by save_snapshot.
+        If the snapshot is missing or stale, the word lists are rebuilt
+        from the Brown corpus and (if rebuild is set) saved back to path."""
+        vocab = cls(common_depth, uncommon_depth, seed=seed, rng=rng)
+        if not vocab.load_snapshot(path) and rebuild:
+            vocab.save_snapshot(path)
+        return vocab
+
+    @property
+    def cfd(self):
+        if self._cfd is None:
+            logging.info("Loading Brown corpus...")
+            self.corpus = nltk.corpus.brown.tagged_words()
+            logging.info("Done.")
+            logging.info("Making frequency distribution...")
+            self._cfd = nltk.ConditionalFreqDist((tag, word) for word, tag in self.corpus)
+            logging.info("Done.")
+        return self._cfd
 
     def read_blacklist(self, blacklist_fn = "blacklist.csv"):
+        self.blacklist_fn = blacklist_fn
         with open(blacklist_fn, "r") as f:
-            self.blacklist = [word.strip() for word in f]
+            self.blacklist = set(word.strip() for word in f)
+
+    def snapshot_key(self):
+        return (self.snapshot_version, self.common_depth, self.uncommon_depth,
+                files_digest([self.blacklist_fn] + self.coll_files))
+
+    def save_snapshot(self, path=VOCAB_SNAPSHOT):
+        logging.info("Filtering word lists for every tag...")
+        for tag in self.cfd.conditions():
+            self.common_words(tag)
+            self.uncommon_words(tag)
+        self.complete = True
+        logging.info("Saving vocabulary snapshot to {}...".format(path))
+        snapshot = {"key": self.snapshot_key(),
+                    "common_tag_words": self.common_tag_words,
+                    "uncommon_tag_words": self.uncommon_tag_words}
+        # Written beside the snapshot and moved into place, so other processes
+        # starting at the same time never read half of it
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+        logging.info("Done.")
+
+    def load_snapshot(self, path=VOCAB_SNAPSHOT):
+        if not os.path.exists(path):
+            logging.info("No vocabulary snapshot at {}.".format(path))
+            return False
+        logging.info("Loading vocabulary snapshot from {}...".format(path))
+        try:
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+            stale = snapshot["key"] != self.snapshot_key()
+        except (EOFError, pickle.UnpicklingError, KeyError) as e:
+            logging.warning("Vocabulary snapshot {} is unreadable: {!r}".format(path, e))
+            return False
+        if stale:
+            logging.warning("Vocabulary snapshot {} is stale.".format(path))
+            return False
+        self.common_tag_words = snapshot["common_tag_words"]
+        self.uncommon_tag_words = snapshot["uncommon_tag_words"]
+        self.complete = True
+        logging.info("Done.")
+        return True
 
     def find_common_words(self, tag, depth):
+        if self.complete:
+            # Every tag in the corpus is already listed, so this one has no words.
+            return []
         logging.debug("Initializing {} to depth {}...".format(tag, depth))
         word_list = [word for word, count in self.cfd[tag].most_common(depth)]
         return self.wordlist_filter(word_list)
 
     def wordlist_filter(self, word_list):
+        listed = set(word_list)
+
         def word_filter(word):
             in_dict = word.lower() in dictionary
-            unneeded_cap = word[0].isupper() and word.lower() in word_list
+            unneeded_cap = word[0].isupper() and word.lower() in listed
             on_blacklist = word in self.blacklist
             return in_dict and word.isalpha() and not unneeded_cap and not on_blacklist
 
@@ -582,12 +1459,35 @@ class Vocab(object):
                 if pos_tag not in self.collection_pool:
                     self.collection_pool[pos_tag] = []
                 self.collection_pool[pos_tag].append(word)
+            self.collections_in_use.append(collection_id)
+            self.drop_pools("collection")
 
     def clear_collections(self):
         self.collection_pool = {}
+        self.collections_in_use = []
+        self.drop_pools("collection")
+
+    def rhyme_classes(self, tag):
+        """Groups the uncommon words for a tag by rhyme key, and
+        remembers each word's rank in the corpus."""
+        if tag not in self.rhyme_index:
+            logging.debug("Indexing rhymes for {}...".format(tag))
+            classes, ranks = {}, {}
+            for rank, word in enumerate(self.uncommon_words(tag)):
+                ranks[word] = rank
+                for key in word_cache.get(word.lower()).rhyme_keys:
+                    classes.setdefault(key, []).append(word)
+            self.rhyme_index[tag] = classes, ranks
+        return self.rhyme_index[tag]
 
     def rhyming_words(self, source_word, pos_tag):
-        rhymes = [word for word in self.uncommon_words(pos_tag) if source_word.rhymes_with(Word(word))]
+        classes, ranks = self.rhyme_classes(pos_tag)
+        keys = source_word.rhyme_keys()
+        matches = [word for key in keys for word in classes.get(key, [])]
+        if len(keys) > 1:
+            # Keep the corpus ranking when several rhyme classes are merged
+            matches = sorted(set(matches), key=ranks.get)
+        rhymes = [word for word in matches if word.lower() != source_word.text]
         if not rhymes:
             logging.debug("No uncommon rhymes found for \'{}\' in {}".format(source_word.text, pos_tag))
         return rhymes
@@ -599,10 +1499,10 @@ class Vocab(object):
         return self.uncommon_tag_words[tag]
 
     def make_common_pool(self, tag):
-        return self.not_used(self.common_words(tag))
+        return self.live_pool("common", tag, self.common_words)
 
     def make_collection_pool(self, tag):
-        return self.not_used(self.collection_words(tag))
+        return self.live_pool("collection", tag, self.collection_words)
 
     def make_rhyme_pool(self, source_words, tag):
         rhyme_pool = []
@@ -613,8 +1513,108 @@ class Vocab(object):
     def not_used(self, word_list):
         return [word for word in word_list if word not in self.used]
 
+    def live_pool(self, kind, tag, source):
+        """The unused words of source(tag). The list is built once and
+        shared, and use() takes words out of it as they're used."""
+        key = (kind, tag)
+        if key not in self.live_pools:
+            pool = []
+            for word in source(tag):
+                if word in self.used:
+                    self.used_pools.setdefault(word, set()).add(key)
+                else:
+                    pool.append(word)
+                    self.pool_index.setdefault(word, set()).add(key)
+            self.live_pools[key] = pool
+        return self.live_pools[key]
+
+    def pool_source(self, kind):
+        return {"common": self.common_words, "collection": self.collection_words}[kind]
+
+    def stress_pool(self, kind, tag):
+        """The live pool for a tag, bucketed by stress pattern (and so
+        by syllable count). Kept up to date by use() along with the pool."""
+        key = (kind, tag)
+        if key not in self.stress_pools:
+            self.stress_pools[key] = index_by_stress(self.live_pool(kind, tag, self.pool_source(kind)))
+        return self.stress_pools[key]
+
+    def find_words(self, tag, pattern=None, syllables=None, kind="common"):
+        """Unused words for a tag with a given stress pattern and/or number
+        of syllables, e.g. find_words("NN", syllables=1) for one-syllable nouns."""
+        words = []
+        for stress, bucket in self.stress_pool(kind, tag).iteritems():
+            if pattern is not None and stress != pattern:
+                continue
+            if syllables is not None and len(stress) != syllables:
+                continue
+            words.extend(bucket)
+        return words
+
+    def drop_pools(self, kind):
+        for key in [key for key in self.live_pools if key[0] == kind]:
+            del self.live_pools[key]
+            self.stress_pools.pop(key, None)
+
+    def use(self, words):
+        for word in words:
+            if word in self.used:
+                continue
+            self.used.add(word)
+            keys = self.pool_index.pop(word, set())
+            self.used_pools.setdefault(word, set()).update(keys)
+            for key in keys:
+                pool = self.live_pools.get(key)
+                if pool is not None:
+                    pool[:] = [other for other in pool if other != word]
+                buckets = self.stress_pools.get(key)
+                if buckets is not None:
+                    for syl_string in word_cache.get(word.lower()).variants:
+                        bucket = [other for other in buckets.get(syl_string, []) if other != word]
+                        if bucket:
+                            buckets[syl_string] = bucket
+                        else:
+                            buckets.pop(syl_string, None)
+
+    def release(self, words):
+        """Makes used words available again. Only the live pools the words
+        were taken out of are rebuilt, in place, so every other pool (and
+        whatever was worked out from it) stays as it is."""
+        affected = set()
+        for word in words:
+            if word in self.used:
+                self.used.discard(word)
+                affected.update(self.used_pools.pop(word, ()))
+        for key in affected:
+            pool = self.live_pools.get(key)
+            if pool is None:
+                continue
+            kind, tag = key
+            # Rebuilt rather than appended to, so the pool keeps its order
+            pool[:] = self.not_used(self.pool_source(kind)(tag))
+            for word in pool:
+                self.pool_index.setdefault(word, set()).add(key)
+            buckets = self.stress_pools.get(key)
+            if buckets is not None:
+                buckets.clear()
+                buckets.update(index_by_stress(pool))
+
+    def clear_used(self):
+        self.release(list(self.used))
+
+    def similarity_index(self, path=SIMILARITY_INDEX):
+        """The collections' WordNet index, loaded from path, or built and
+        saved there if it's missing or the collections have changed."""
+        if self._similarity_index is None:
+            key = SimilarityIndex.key(self.coll_files)
+            self._similarity_index = SimilarityIndex.load(path, key)
+            if self._similarity_index is None:
+                self._similarity_index = SimilarityIndex.build(self.collections)
+                self._similarity_index.save(path, key)
+        return self._similarity_index
+
     def add_random_collections(self, number=2):
-        coll_ids = random.sample(self.collections.keys(), number)
+        coll_ids = self.rng.sample(sorted(self.collections.keys()), number)
         for coll_id in coll_ids:
             self.add_collection(coll_id)
 
@@ -633,36 +1633,225 @@ class Prompter(object):
         self.prompt_meanings = [wn.synsets(word) for word in self.user_prompt_words]
 
     def pick_collection(self):
+        index = self.vocab.similarity_index()
         max_sim = 0
         best_match = None
         for meaning in self.prompt_meanings:
             for synset in meaning:
+                similarities = index.max_similarities(synset, 3)
                 for collection in self.vocab.collections.values():
-                    match_strength = sum(collection.max_similarities(synset, 3))
+                    match_strength = sum(similarities[collection.id])
                     if match_strength > max_sim:
                         max_sim = match_strength
                         best_match = collection
         return best_match
 
 
+class CandidateReservoir(object):
+    """Scanning lines made for a template but never used, kept so later
+    poems can offer them again instead of making new ones.
+
+    Lines are filed by template, meter and the collections in use, since
+    those decide which words a line could have been made from. A line is
+    dropped once it has been offered max_offers times, or when it's taken
+    and turns out to hold a word that's already used. Past maxsize lines
+    in all, the least recently used template's oldest lines go first.
+
+    The lock only guards the stock: making the lines that go in it uses
+    the writer's pools and rng, which aren't safe to share between threads."""
+
+    def __init__(self, maxsize=20000, max_offers=3):
+        self.maxsize = maxsize
+        self.max_offers = max_offers
+        self.stock = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def key(template, vocab, meter):
+        return template.id if template.id is not None else id(template), meter, tuple(sorted(vocab.collections_in_use))
+
+    def stock_for(self, key):
+        with self.lock:
+            return len(self.stock.get(key, ()))
+
+    def take(self, key, number, used):
+        """Up to number lines for key, none with a word in used."""
+        lines = []
+        with self.lock:
+            entries = self.stock.pop(key, [])
+            while entries and len(lines) < number:
+                line, offers = entries.pop(0)
+                self.size -= 1
+                if any(word in used for word in line.chosen_words()):
+                    self.stale += 1
+                    continue
+                line.offers = offers + 1
+                lines.append(line)
+            if entries:
+                self.stock[key] = entries
+            self.hits += len(lines)
+            self.misses += number - len(lines)
+        return lines
+
+    def put(self, key, lines):
+        with self.lock:
+            entries = self.stock.pop(key, [])
+            for line in lines:
+                offers = getattr(line, "offers", 0)
+                if offers < self.max_offers:
+                    entries.append((line, offers))
+                    self.size += 1
+            self.stock[key] = entries
+            while self.size > self.maxsize:
+                oldest = next(iter(self.stock))
+                self.stock[oldest].pop(0)
+                self.size -= 1
+                self.evictions += 1
+                if not self.stock[oldest]:
+                    del self.stock[oldest]
+
+    def clear(self):
+        with self.lock:
+            self.stock.clear()
+            self.size = 0
+
+    def stats(self):
+        lines = self.hits + self.misses
+        return {"size": self.size,
+                "templates": len(self.stock),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "reuse_rate": float(self.hits) / lines if lines else 0.0}
+
+
+def pack_lengths(lengths, capacities, fits=None, rng=None):
+    """Puts each of lengths in one of the bins with the given capacities,
+    so none overflows and the room left in every bin satisfies fits (by
+    default, that no room is left). Returns the bin index for each length,
+    or None if they can't be packed. With an rng the bins are tried in a
+    random order, so repeated calls give different packings."""
+    if fits is None:
+        fits = lambda room: room == 0
+    order = range(len(capacities))
+    if rng is not None:
+        rng.shuffle(order)
+    remaining = list(capacities)
+    placement = [None] * len(lengths)
+    # Bins with the same room left are interchangeable, so a dead end only
+    # depends on how much room is left, not where.
+    dead_ends = set()
+
+    def place(index):
+        if index == len(lengths):
+            return all(fits(room) for room in remaining)
+        state = (index, tuple(sorted(remaining)))
+        if state in dead_ends:
+            return False
+        tried = set()
+        for bin_index in order:
+            room = remaining[bin_index]
+            if room < lengths[index] or room in tried:
+                continue
+            tried.add(room)
+            remaining[bin_index] -= lengths[index]
+            placement[index] = bin_index
+            if place(index + 1):
+                return True
+            remaining[bin_index] += lengths[index]
+        dead_ends.add(state)
+        return False
+
+    if place(0):
+        return placement
+    return None
+
+
 class SonnetWriter(object):
     """docstring for SonnetWriter"""
 
-    def __init__(self, vocab):
+    def __init__(self, vocab, seed=None, rng=None, reservoir=None):
         self.vocab = vocab
+        # Share the vocab's random stream unless given one, so one seed covers everything
+        self.rng = rng if rng is not None else vocab.rng
+        if seed is not None:
+            self.seed(seed)
+        # Lines kept from earlier poems make each poem depend on the ones before,
+        # so seeded runs only use a reservoir if they're given one.
+        self.reservoir = reservoir
+        # Reservoir keys refill_reservoir couldn't make lines for
+        self.unfillable = set()
+        # Hold line candidates left over from pairs already rhymed, by position in the poem
+        self.section_candidates = {}
+        self.current_poem = None
         self.lines, self.line_groups = [], []
 
+    def seed(self, seed):
+        self.rng.seed(seed)
+
+    def meter(self):
+        if self.current_poem is None:
+            return iambic_pentameter
+        return self.current_poem.meter
+
+    @property
+    def template_pool(self):
+        return self._template_pool
+
+    @template_pool.setter
+    def template_pool(self, templates):
+        if not isinstance(templates, TemplatePool):
+            templates = TemplatePool(templates)
+        self._template_pool = templates
+
     def load_templates(self, filename):
         self.template_pool = TemplateReader(filename).read()
 
     def pick_lines(self):
+        """Picks whole sentences until the poem's lines are all taken,
+        drawing only sentences that leave the sections packable."""
+        catalog = self.template_pool.sentence_lengths(max(self.current_poem.section_lengths))
+        available_templates = None
         while len(self.lines) < sum(self.current_poem.section_lengths):
-            available_templates = [template for template in self.template_pool if template not in self.lines]
-            new_template = random.choice(available_templates)
+            # Only changes when lines are added, not on every failed match
+            if available_templates is None:
+                used = set(self.lines)
+                fitting = self.fitting_lengths()
+                available_templates = [template for template in self.template_pool
+                                       if template not in used and catalog[template] & fitting]
+                if not available_templates:
+                    msg = "No sentences fit around line groups of lengths {}.".format(
+                        [len(group) for group in self.line_groups])
+                    raise ConstructionFailure(self.line_groups, msg)
+            new_template = self.rng.choice(available_templates)
             new_lines = self.match_transitions(new_template)
-            if new_lines:
-                if len(self.lines) + len(new_lines) <= sum(self.current_poem.section_lengths):
-                    self.add_lines(new_lines)
+            if new_lines and len(new_lines) in fitting:
+                self.add_lines(new_lines)
+                available_templates = None
+
+    def fitting_lengths(self):
+        """The sentence lengths that could be added to the line groups in
+        hand without making the poem's sections impossible to fill."""
+        section_lengths = self.current_poem.section_lengths
+        catalog = self.template_pool.sentence_lengths(max(section_lengths))
+        possible = frozenset().union(*catalog.values())
+        # The room any mix of possible sentences could fill exactly
+        fillable = set([0])
+        for room in xrange(1, max(section_lengths) + 1):
+            if any(room - length in fillable for length in possible):
+                fillable.add(room)
+        group_lengths = [len(group) for group in self.line_groups]
+        return set(length for length in possible
+                   if pack_lengths(group_lengths + [length], section_lengths, fits=fillable.__contains__) is not None)
 
     def add_lines(self, lines):
         self.lines.extend(lines)
@@ -672,22 +1861,26 @@ class SonnetWriter(object):
 
     def match_transitions(self, start_template):
         complete_sentence = [start_template]
+        unavailable = set(self.lines)
+        unavailable.add(start_template)
         while complete_sentence[0].intro_required:
-            candidates = [template for template in self.template_pool if template.outro == complete_sentence[
-                0].intro_required and template not in self.lines and template not in complete_sentence]
+            candidates = [template for template in self.template_pool.preceding(complete_sentence[0])
+                          if template not in unavailable]
             try:
-                intro = random.choice(candidates)
+                intro = self.rng.choice(candidates)
                 complete_sentence.insert(0, intro)
+                unavailable.add(intro)
             except IndexError:
                 logging.warning(
                     "No {} match found for template: {}".format(start_template.intro_required, start_template.raw_text))
                 return False
         while complete_sentence[-1].outro_required:
-            candidates = [template for template in self.template_pool if template.intro == complete_sentence[
-                -1].outro_required and template not in self.lines and template not in complete_sentence]
+            candidates = [template for template in self.template_pool.following(complete_sentence[-1])
+                          if template not in unavailable]
             try:
-                outro = random.choice(candidates)
+                outro = self.rng.choice(candidates)
                 complete_sentence.append(outro)
+                unavailable.add(outro)
             except IndexError:
                 logging.warning(
                     "No {} match found for template: {}".format(start_template.outro_required, start_template.raw_text))
@@ -698,38 +1891,67 @@ class SonnetWriter(object):
     # Used to force inclusion of a particular template, for building sample size.
         if template not in self.lines:
             new_lines = self.match_transitions(template)
-            if new_lines and len(self.lines) + len(new_lines) <= sum(self.current_poem.section_lengths):
+            if new_lines and len(new_lines) in self.fitting_lengths():
                 self.add_lines(new_lines)
 
 
-    def arrange_lines(self):
-        for section in sorted(self.current_poem.sections, key= lambda x: len(x.template_list)):
-            # Go smallest to largest because small sections are more restrictive
-            fail_count = 0
-            new_section = []
-            while len(new_section) < len(section.template_list):
-                candidate = random.choice(self.line_groups)
-                if len(new_section) + len(candidate) <= len(section.template_list):
-                    new_section.extend(candidate)
-                    self.line_groups.remove(candidate)
-                else:
-                    fail_count += 1
-                if fail_count >= 20:
-                    msg = "Unable to fill section of length {} from remaining templates.".format(len(section.template_list))
-                    raise ConstructionFailure(self.line_groups, msg)
-            section.template_list = new_section
+    def arrange_lines(self, sections=None):
+        """Shares the line groups out between the sections so each is
+        filled exactly, picking one of the possible arrangements at random.
+        Raises ConstructionFailure only if there is no such arrangement."""
+        if sections is None:
+            sections = self.current_poem.sections
+        line_groups = list(self.line_groups)
+        self.rng.shuffle(line_groups)
+        placement = pack_lengths([len(group) for group in line_groups],
+                                 [len(section.template_list) for section in sections], rng=self.rng)
+        if placement is None:
+            msg = "Line groups of lengths {} can't fill sections of lengths {}.".format(
+                sorted(len(group) for group in line_groups), [len(section.template_list) for section in sections])
+            raise ConstructionFailure(self.line_groups, msg)
+        for section_index, section in enumerate(sections):
+            section.line_groups = [group for group, index in zip(line_groups, placement) if index == section_index]
+            section.template_list = [template for group in section.line_groups for template in group]
+        self.line_groups = []
+
+    def arrange_sections(self, sections, attempts=5):
+        """Shares the line groups in hand between the given sections,
+        trying a few arrangements before giving up on the groups.
+        Arrangements that pair up two inflexible templates are passed over."""
+        line_groups = list(self.line_groups)
+        for _ in xrange(attempts):
+            self.line_groups = list(line_groups)
+            try:
+                self.arrange_lines(sections)
+            except ConstructionFailure:
+                # No arrangement at all, so trying again won't help
+                self.line_groups = line_groups
+                raise
+            if all(self.matchable(section) for section in sections):
+                return
+        self.line_groups = line_groups
+        msg = "No arrangement found for {} line groups.".format(len(line_groups))
+        raise ConstructionFailure(line_groups, msg)
+
+    def rearrange_unfilled(self):
+        """Reshuffles the lines of the unfilled sections between them,
+        leaving the finished sections alone."""
+        unfilled = self.current_poem.unfilled_sections()
+        self.line_groups = [group for section in unfilled for group in section.line_groups]
+        self.arrange_sections(unfilled)
 
     def pick_rhymes(self, template_pair, retries=5):
         fail_count = 0
         logging.debug(
             "Finding rhymes for templates:\n{}\n{}".format(template_pair[0].raw_text, template_pair[1].raw_text))
         while True:
-            self.force_rhyme_cands(template_pair)
+            hold_line = self.force_rhyme_cands(template_pair)
             rhymes = self.select_rhyming_candidates(template_pair)
             if rhymes:
-                for template, rhyming_line in zip(template_pair, random.choice(rhymes)):
+                for template, rhyming_line in zip(template_pair, self.rng.choice(rhymes)):
                     template.filled_line = rhyming_line
-                    self.vocab.used.extend(rhyming_line.choices)
+                    self.vocab.use(rhyming_line.chosen_words())
+                self.recycle_candidates(hold_line)
                 return
             else:
                 fail_count += 1
@@ -739,10 +1961,20 @@ class SonnetWriter(object):
                 raise PairFailure(template_pair, msg)
 
     def select_rhyming_candidates(self, template_pair):
+        # Group the second template's candidates by rhyme key, so each of the
+        # first's only meets the candidates it could rhyme with.
+        by_key = {}
+        for index, candidate2 in enumerate(template_pair[1].candidates):
+            for key in candidate2.rhyme_keys():
+                by_key.setdefault(key, []).append(index)
         rhyme_pairs = []
         for candidate1 in template_pair[0].candidates:
-            for candidate2 in template_pair[1].candidates:
-                if candidate1.rhymes_with(candidate2) and not candidate1.same_choices(candidate2):
+            matches = set(index for key in candidate1.rhyme_keys() for index in by_key.get(key, []))
+            for index in sorted(matches):
+                # Same order as comparing every pair, so seeded runs don't change
+                candidate2 = template_pair[1].candidates[index]
+                if candidate1.word_list[-1].text != candidate2.word_list[-1].text \
+                        and not candidate1.same_choices(candidate2):
                     rhyme_pairs.append([candidate1, candidate2])
         return rhyme_pairs
 
@@ -755,7 +1987,7 @@ class SonnetWriter(object):
         if len(nonflexible) == 1:
             return nonflexible[0]
         else:
-            return random.choice(template_pair)
+            return self.rng.choice(template_pair)
 
     def force_rhyme_cands(self, template_pair):
         hold_line = self.pick_hold_template(template_pair)
@@ -763,35 +1995,134 @@ class SonnetWriter(object):
         # Slightly magic: if hold_line is [0], then -1 gets you [1]
         # If hold_line is [1], -1 gets you [0]
         hold_line.make_pools(self.vocab)
-        hold_line.make_candidates()
+        self.make_hold_candidates(hold_line)
         reach_line.convert_to_rhyme(hold_line.last_words())
         try:
             reach_line.make_pools(self.vocab)
-            reach_line.make_candidates()
+            reach_line.make_candidates(rng=self.rng, meter=self.meter())
         except RhymeFailure as e:
             logging.warning(e.msg)
-            return
         finally:
             reach_line.restore_from_rhyme()
+        return hold_line
+
+    def make_hold_candidates(self, template, depth=20):
+        """Candidates for the line rhymes are found for, taken from the
+        reservoir where it has them and made fresh where it doesn't."""
+        if self.reservoir is None:
+            # A section that's started over gets back what its lines had, less any now-used words
+            kept = self.section_candidates.pop(self.section_key(template), [])
+            candidates = [line for line in kept
+                          if not any(word in self.vocab.used for word in line.chosen_words())][:depth]
+            candidates.extend(template.make_scanning_line(rng=self.rng, meter=self.meter())
+                              for _ in xrange(depth - len(candidates)))
+            template.candidates = candidates
+            return
+        key = self.reservoir.key(template, self.vocab, self.meter())
+        candidates = self.reservoir.take(key, depth, self.vocab.used)
+        candidates.extend(template.make_scanning_line(rng=self.rng, meter=self.meter())
+                          for _ in xrange(depth - len(candidates)))
+        template.candidates = candidates
+
+    def recycle_candidates(self, template):
+        # Only the hold line's candidates are worth keeping; the other line's were made to rhyme with them.
+        leftovers = [line for line in template.candidates if line is not template.filled_line]
+        if self.reservoir is None:
+            self.section_candidates[self.section_key(template)] = leftovers
+            return
+        self.reservoir.put(self.reservoir.key(template, self.vocab, self.meter()), leftovers)
+
+    def section_key(self, template):
+        """Where a template sits in the current poem: its section and line."""
+        if self.current_poem is not None:
+            for section_index, section in enumerate(self.current_poem.sections):
+                if template in section.template_list:
+                    return section_index, section.template_list.index(template), template
+        return None, None, template
+
+    def refill_reservoir(self, number=1, depth=20, target=40):
+        """Tops up the reservoir, up to target lines each, for the templates
+        it holds least for given the collections in use. Returns False if
+        there was nothing to do: the reservoir is full or every template
+        that can be filled has its target.
+
+        It makes pools and draws words from the writer's rng and vocab, so
+        call it from the thread writing poems, between poems, never while
+        one is being written."""
+        if self.reservoir is None or len(self.reservoir) + depth > self.reservoir.maxsize:
+            return False
+        keys = dict((template, self.reservoir.key(template, self.vocab, self.meter())) for template in self.template_pool)
+        stocks = dict((template, self.reservoir.stock_for(key)) for template, key in keys.items())
+        short = [template for template in self.template_pool
+                 if stocks[template] < target and keys[template] not in self.unfillable]
+        if not short:
+            return False
+        for template in sorted(short, key=stocks.get)[:number]:
+            template.make_pools(self.vocab)
+            try:
+                lines = [template.make_scanning_line(rng=self.rng, meter=self.meter()) for _ in xrange(depth)]
+            except ScanFailure as e:
+                logging.debug(e.msg)
+                # Won't do any better next time with the same words
+                self.unfillable.add(keys[template])
+                continue
+            self.reservoir.put(keys[template], lines)
+        return True
 
     def set_coll_prob(self, coll_prob):
         for template in self.template_pool:
             for blank in template.blanks:
                 blank.collection_prob = coll_prob
 
-    def populate(self):
+    def fill_section(self, section, retries=3):
+        """Rhymes each pair in a section. If a pair can't be rhymed, the
+        section gives back its words and starts over, up to retries times."""
+        fail_count = 0
+        while True:
+            try:
+                for template_pair in section.template_pairs():
+                    self.pick_rhymes(template_pair)
+                section.filled = True
+                return
+            except (PairFailure, ScanFailure) as e:
+                logging.warning(e.msg)
+                self.clear_section(section)
+                fail_count += 1
+                if fail_count >= retries or not self.matchable(section):
+                    raise
+
+    def clear_section(self, section):
+        for template in section.template_list:
+            if template.filled_line is not None:
+                self.vocab.release(template.filled_line.chosen_words())
+            template.unfill()
+        section.filled = False
+
+    def matchable(self, section):
+        # Two inflexible templates in a pair will never rhyme however often they're retried
+        return all(any(template.is_flexible() for template in template_pair)
+                   for template_pair in section.template_pairs())
+
+    def populate(self, rearrangements=3):
+        rearranged = 0
         while self.current_poem.unfilled_sections():
-            next_section = random.choice(self.current_poem.unfilled_sections())
-            for template_pair in next_section.template_pairs():
-                self.pick_rhymes(template_pair)
-            next_section.filled = True
+            next_section = self.rng.choice(self.current_poem.unfilled_sections())
+            try:
+                self.fill_section(next_section)
+            except (PairFailure, ScanFailure):
+                if rearranged >= rearrangements:
+                    raise
+                rearranged += 1
+                logging.info("Rearranging unfilled sections...")
+                self.rearrange_unfilled()
 
     def reset(self):
         logging.info("Resetting...")
         self.lines = []
         self.line_groups = []
+        self.section_candidates = {}
         self.current_poem.reset()
-        self.vocab.used = []
+        self.vocab.clear_used()
         for template in self.template_pool:
             template.cleanup()
 
@@ -799,10 +2130,12 @@ class SonnetWriter(object):
         self.current_poem = poem
         successful = False
         while not successful:
+            # Failures are dealt with as locally as possible inside populate();
+            # starting over from new lines is the last resort.
             self.reset()
             try:
                 self.pick_lines()
-                self.arrange_lines()
+                self.arrange_sections(self.current_poem.sections)
                 self.populate()
                 successful = True
             except (ConstructionFailure, PairFailure, ScanFailure) as e:
@@ -815,6 +2148,7 @@ class SonnetWriter(object):
 class Section(object):
     def __init__(self, num_lines):
         self.template_list = [None for _ in xrange(num_lines)]
+        self.line_groups = []
         self.filled = False
 
 
@@ -844,8 +2178,36 @@ class Section(object):
         self.human = input("Human? (0-10):")
         self.offensive = input("Offensive? (0-10):")
 
+    def to_record(self):
+        return {"text": self.text,
+                "lines": [{"template": template.id, "raw_text": template.raw_text, "text": line.text,
+                           "choices": line.choices} for template, line in zip(self.template_list, self.lines)],
+                "interesting": self.interesting,
+                "human": self.human,
+                "offensive": self.offensive}
+
+    @classmethod
+    def from_record(cls, record):
+        section = cls(len(record["lines"]))
+        section.template_list = []
+        for line_record in record["lines"]:
+            template = Template(line_record["raw_text"], [])
+            template.id = line_record["template"]
+            section.template_list.append(template)
+        section.lines = [Line.restore(line_record["text"], line_record["choices"]) for line_record in record["lines"]]
+        section.text = record["text"]
+        section.filled = True
+        section.interesting = record["interesting"]
+        section.human = record["human"]
+        section.offensive = record["offensive"]
+        return section
+
 class Poem(object):
-    def __init__(self, section_lengths):
+    meter = iambic_pentameter
+
+    def __init__(self, section_lengths, meter=None):
+        if meter is not None:
+            self.meter = meter
         self.section_lengths = section_lengths
         self.sections = [Section(length) for length in section_lengths]
 
@@ -875,17 +2237,70 @@ class Poem(object):
     def unfilled_sections(self):
         return [section for section in self.sections if not section.filled]
 
+    def to_record(self):
+        return {"form": self.__class__.__name__,
+                "text": self.text,
+                "sections": [section.to_record() for section in self.sections]}
+
+    @classmethod
+    def from_record(cls, record):
+        poem = object.__new__(poem_forms.get(record["form"], Poem))
+        poem.sections = [Section.from_record(section_record) for section_record in record["sections"]]
+        poem.section_lengths = [len(section.template_list) for section in poem.sections]
+        poem.text = record["text"]
+        return poem
+
 
 class Sonnet(Poem):
-    def __init__(self):
-        super(Sonnet, self).__init__([4, 4, 4, 2])
+    def __init__(self, meter=None):
+        super(Sonnet, self).__init__([4, 4, 4, 2], meter)
 
 
 
 
 class HeroicCouplets(Poem):
-    def __init__(self, num_couplets):
-        super(HeroicCouplets, self).__init__([2 for _ in xrange(num_couplets)])
+    def __init__(self, num_couplets, meter=None):
+        super(HeroicCouplets, self).__init__([2 for _ in xrange(num_couplets)], meter)
+
+
+poem_forms = {"Sonnet": Sonnet, "HeroicCouplets": HeroicCouplets}
+
+
+class PoemWriter(object):
+    """Appends poems to a file as they're finished, one JSON record per line,
+    so an interrupted batch keeps everything written so far."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, poem):
+        self.file.write(json.dumps(poem.to_record()))
+        self.file.write("\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_poems(filename):
+    """Yields the poems in a file written by PoemWriter, one at a time."""
+    with open(filename, "r") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning("Skipping unreadable record on line {} of {}.".format(line_number + 1, filename))
+                continue
+            yield Poem.from_record(record)
 
 
 
@@ -0,0 +1,140 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Test cases for bundle.py
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from nose.tools import *
+import bundle
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+def make_bundle(directory):
+    words = np.array([u"<unk>", u"the", u"cat", u"sat", u"caf\xe9"], dtype=np.unicode_)
+    classes = np.array([u"1", u"2", u"3"], dtype=np.unicode_)
+    model_bundle = bundle.ModelBundle(words, classes, classes, 4, 8)
+    os.makedirs(os.path.join(directory, bundle.HUM_MODEL))
+    with open(os.path.join(directory, bundle.HUM_MODEL, "weights"), "w") as f:
+        f.write("hum")
+    model_bundle.save(directory)
+    return model_bundle
+
+
+class TestModelBundle(object):
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        directory = os.path.join(self.root, "bundle_20160101-000000")
+        saved = make_bundle(directory)
+        loaded = bundle.ModelBundle.load(directory)
+        eq_(loaded.words.tolist(), saved.words.tolist())
+        eq_(loaded.hum_classes.tolist(), saved.hum_classes.tolist())
+        eq_(loaded.int_classes.tolist(), saved.int_classes.tolist())
+        eq_(loaded.max_seq_len, 4)
+        eq_(loaded.embedding_size, 8)
+        eq_(loaded.model_path("hum"), os.path.join(directory, bundle.HUM_MODEL))
+        seqs = [[u"the", u"cat", u"sat"], ["caf\xc3\xa9", u"dog"]]
+        eq_(loaded.transform_seqs(seqs).tolist(), saved.transform_seqs(seqs).tolist())
+        eq_(loaded.transform_seqs(seqs).tolist(), [[1, 2, 3, 0], [4, 0, 0, 0]])
+
+    def test_changed_file(self):
+        directory = os.path.join(self.root, "bundle_20160101-000000")
+        make_bundle(directory)
+        with open(os.path.join(directory, bundle.HUM_MODEL, "weights"), "w") as f:
+            f.write("retrained")
+        assert_raises(bundle.BundleError, bundle.ModelBundle.load, directory)
+        # Without verify the change goes unnoticed
+        bundle.ModelBundle.load(directory, verify=False)
+
+    def test_verified_hashes(self):
+        directory = os.path.join(self.root, "bundle_20160101-000000")
+        make_bundle(directory)
+        weights = os.path.join(directory, bundle.HUM_MODEL, "weights")
+        hashed = []
+        file_hash = bundle.file_hash
+        bundle.file_hash = lambda filename: hashed.append(filename) or file_hash(filename)
+        try:
+            bundle.ModelBundle.load(directory)
+            eq_(len(hashed), 2)
+            ok_(os.path.exists(os.path.join(directory, bundle.VERIFIED)))
+            # Nothing has changed, so nothing is read again
+            bundle.ModelBundle.load(directory)
+            eq_(len(hashed), 2)
+            # Same size, new contents and mtime
+            with open(weights, "w") as f:
+                f.write("HUM")
+            stat = os.stat(weights)
+            os.utime(weights, (stat.st_atime, stat.st_mtime + 10))
+            assert_raises(bundle.BundleError, bundle.ModelBundle.load, directory)
+            eq_(hashed[2:], [weights])
+        finally:
+            bundle.file_hash = file_hash
+        eq_(bundle.bundle_files(directory), [os.path.join(bundle.HUM_MODEL, "weights"), bundle.VOCAB])
+
+    def test_missing_manifest(self):
+        directory = os.path.join(self.root, "bundle_20160101-000000")
+        make_bundle(directory)
+        # A newer bundle that was never finished
+        os.makedirs(os.path.join(self.root, "bundle_20160102-000000"))
+        assert_raises(bundle.BundleError, bundle.ModelBundle.load,
+                      os.path.join(self.root, "bundle_20160102-000000"))
+        eq_(bundle.latest_bundle(self.root), directory)
+
+    def test_latest_bundle(self):
+        eq_(bundle.latest_bundle(self.root), None)
+        for day in ["01", "03", "02"]:
+            make_bundle(os.path.join(self.root, "bundle_201601{}-000000".format(day)))
+        newest = os.path.join(self.root, "bundle_20160103-000000")
+        eq_(bundle.latest_bundle(self.root), newest)
+        eq_(bundle.load_latest_bundle(self.root).directory, newest)
+        # A corrupt newest bundle falls back to the one before it
+        with open(os.path.join(newest, bundle.VOCAB), "ab") as f:
+            f.write("junk")
+        eq_(bundle.latest_bundle(self.root), os.path.join(self.root, "bundle_20160102-000000"))
+
+
+class TestEncodeSeqs(object):
+    def setup(self):
+        self.mapping = {"the": 1, "cat": 2, "sat": 3}
+
+    def test_truncate(self):
+        x = bundle.encode_seqs(self.mapping, 2, 4, [["the", "cat", "sat"]])
+        eq_(x.tolist(), [[1, 2]])
+
+    def test_pad(self):
+        x = bundle.encode_seqs(self.mapping, 4, 4, [["sat"], [], ["the", "cat"]])
+        eq_(x.shape, (3, 4))
+        eq_(x.tolist(), [[3, 0, 0, 0], [0, 0, 0, 0], [1, 2, 0, 0]])
+
+    def test_unknown(self):
+        x = bundle.encode_seqs(self.mapping, 3, 4, [["the", "dog", "sat"]])
+        eq_(x.tolist(), [[1, 0, 3]])
+
+    def test_dtype(self):
+        x = bundle.encode_seqs(self.mapping, 3, 4, [["cat"]], dtype=np.int16)
+        eq_(x.dtype, np.int16)
+        eq_(x.tolist(), [[2, 0, 0]])
+        # Ids run up to n_words - 1, so 256 words just fit in a uint8
+        bundle.encode_seqs(self.mapping, 3, 256, [["cat"]], dtype=np.uint8)
+        assert_raises(ValueError, bundle.encode_seqs, self.mapping, 3, 257, [["cat"]], np.uint8)
+        assert_raises(ValueError, bundle.encode_seqs, self.mapping, 3, 1 << 16, [["cat"]], np.int16)
@@ -0,0 +1,70 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Test cases for rate.py
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from nose.tools import *
+import sonnet as snt
+import rate
+import os
+import tempfile
+
+
+def rated_couplets(words):
+    template = snt.Template("the {} will {} the {} of day,", [snt.Blank(tag) for tag in ["NN", "VB", "NN"]])
+    template.id = 7
+    couplets = snt.HeroicCouplets(1)
+    section = couplets.sections[0]
+    section.template_list = [template, template]
+    template.filled_line = template.make_line(words)
+    couplets.make_text()
+    # Already rated, so main doesn't stop to ask
+    section.interesting = 3
+    return couplets
+
+
+class TestRecordMode(object):
+    def setup(self):
+        self.filenames = []
+        for _ in xrange(2):
+            handle, filename = tempfile.mkstemp(suffix=".jsonl")
+            os.close(handle)
+            self.filenames.append(filename)
+        self.input, self.output = self.filenames
+
+    def teardown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def test_resume(self):
+        poems = [rated_couplets(words) for words in [["sun", "paint", "close"],
+                                                     ["moon", "steal", "light"],
+                                                     ["sea", "drown", "end"]]]
+        with snt.PoemWriter(self.input) as output:
+            for poem in poems:
+                output.write(poem)
+        # An earlier session got through the first poem
+        with snt.PoemWriter(self.output) as output:
+            output.write(poems[0])
+        rate.main({"input": self.input, "output": self.output})
+        eq_([poem.text for poem in snt.read_poems(self.output)], [poem.text for poem in poems])
+        rate.main({"input": self.input, "output": self.output})
+        eq_(len(list(snt.read_poems(self.output))), 3)
+
+    def test_same_file(self):
+        assert_raises(SystemExit, rate.parse_args, ["-i", self.input, "-o", self.input])
+        eq_(rate.parse_args(["-i", self.input, "-o", self.output])["output"], self.output)
@@ -0,0 +1,114 @@
+# Author: Russell Williams
+# Email: russell.d.williams@gmail.com
+# Copyright 2016
+
+# Test cases for scorer.py
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from nose.tools import *
+import scorer
+import time
+import Queue
+
+
+def couplet_record(text, human=None, interesting=None):
+    lines = text.split("\n")
+    return {"text": text + "\n",
+            "lines": [{"template": index, "raw_text": line, "text": line, "choices": []}
+                      for index, line in enumerate(lines)],
+            "interesting": interesting,
+            "human": human,
+            "offensive": None}
+
+
+class StubScorer(object):
+    """Rates a couplet by the length of its text, without TensorFlow."""
+
+    def __init__(self, pipeline=None, batches=1):
+        self.pipeline = pipeline
+        self.batches = batches
+        self.batch_sizes = []
+
+    def rate_sections(self, sections):
+        self.batch_sizes.append(len(sections))
+        for section in sections:
+            section.human = float(len(section.text))
+            section.interesting = 1.0
+        if self.pipeline and len(self.batch_sizes) >= self.batches:
+            self.pipeline.stopping.set()
+        return sections
+
+
+class TestRankedBuffer(object):
+    def test_push_take(self):
+        buf = scorer.RankedBuffer(10)
+        for score, item in [(2, "b"), (5, "e"), (1, "a"), (4, "d"), (3, "c")]:
+            buf.push(score, item)
+        eq_(buf.take(2), ["e", "d"])
+        eq_(len(buf), 3)
+        eq_(buf.take(5), ["c", "b", "a"])
+        eq_(len(buf), 0)
+
+    def test_equal_scores(self):
+        buf = scorer.RankedBuffer(10)
+        buf.push(1, {"unorderable": 1})
+        buf.push(1, {"unorderable": 2})
+        eq_(len(buf.take(2)), 2)
+
+    def test_eviction(self):
+        buf = scorer.RankedBuffer(3)
+        for score in [5, 1, 4, 2, 3]:
+            buf.push(score, score)
+        eq_(len(buf), 3)
+        # A new item worse than everything kept is dropped
+        buf.push(0, 0)
+        eq_(buf.take(3), [5, 4, 3])
+
+    def test_take_timeout(self):
+        buf = scorer.RankedBuffer(10)
+        buf.push(1, "a")
+        start = time.time()
+        eq_(buf.take(3, timeout=0.2), ["a"])
+        ok_(time.time() - start >= 0.2)
+        start = time.time()
+        eq_(buf.take(1), [])
+        ok_(time.time() - start < 0.2)
+
+
+class TestCoupletPipeline(object):
+    def setup(self):
+        self.pipeline = scorer.CoupletPipeline(workers=0, batch_size=3, buffer_size=10)
+        # A plain queue stands in for the one the worker processes would fill
+        self.pipeline.queue = Queue.Queue()
+
+    def test_next_batch(self):
+        for index in xrange(5):
+            self.pipeline.queue.put(couplet_record("line {}\nline".format(index)))
+        eq_(len(self.pipeline.next_batch()), 3)
+        eq_(len(self.pipeline.next_batch()), 2)
+        assert_raises(Queue.Empty, self.pipeline.next_batch)
+
+    def test_rate_batches(self):
+        for text in ["a\nb", "a longer\ncouplet", "mid\ndle"]:
+            self.pipeline.queue.put(couplet_record(text))
+        stub = StubScorer(self.pipeline)
+        self.pipeline.start(stub)
+        self.pipeline.consumer.join(5)
+        ok_(not self.pipeline.consumer.is_alive())
+        eq_(stub.batch_sizes, [3])
+        eq_(self.pipeline.rated, 3)
+        best = self.pipeline.best(2, timeout=0)
+        eq_([section.text for section in best.sections], ["a longer\ncouplet\n", "mid\ndle\n"])
+        eq_(best.section_lengths, [2, 2])
@@ -20,6 +20,8 @@
 from nose.tools import *
 import sonnet as snt
 import random
+import os
+import tempfile
 
 vocab = snt.Vocab()
 templates = snt.TemplateReader("line_templates.csv").read()
@@ -30,12 +32,13 @@ class TestWord(object):
         a = snt.Word("dog")
         a.look_up()
         ok_(not a.multi_prons)
-        ok_(isinstance(a.pron, list))
+        ok_(isinstance(a.pron, tuple))
 
         b = snt.Word("fire")
         b.look_up()
         ok_(b.multi_prons)
-        ok_(isinstance(b.pron, list))
+        ok_(isinstance(b.pron, tuple))
+        ok_(isinstance(b.pron[0], tuple))
 
     def test_syl_count(self):
         a = snt.Word("dog")
@@ -74,24 +77,24 @@ class TestWord(object):
         a = snt.Word("dog")
         a.find_last_sounds()
 
-        ok_(isinstance(a.last_sounds, list))
-        eq_(a.last_sounds, [["AO", "G"]])
+        ok_(isinstance(a.last_sounds, tuple))
+        eq_(a.last_sounds, (("AO", "G"),))
 
         b = snt.Word("frog")
         b.find_last_sounds()
-        eq_(b.last_sounds, [["AA", "G"]])
+        eq_(b.last_sounds, (("AA", "G"),))
 
         c = snt.Word("thirst")
         c.find_last_sounds()
-        eq_(c.last_sounds, [["ER", "S", "T"]])
+        eq_(c.last_sounds, (("ER", "S", "T"),))
 
         d = snt.Word("go")
         d.find_last_sounds()
-        eq_(d.last_sounds, [["OW"]])
+        eq_(d.last_sounds, (("OW",),))
 
         e = snt.Word("proprietary")
         e.find_last_sounds()
-        eq_(e.last_sounds, [["EH", "R", "IY"]])
+        eq_(e.last_sounds, (("EH", "R", "IY"),))
 
     def test_rhymes(self):
         # ok_(snt.Word("frog").rhymes_with(snt.Word("dog")))
@@ -102,6 +105,109 @@ class TestWord(object):
         ok_(not snt.Word("frog").rhymes_with(snt.Word("fraud")))
         ok_(snt.Word("proprietary").rhymes_with(snt.Word("dairy")))
 
+    def test_rhyme_keys(self):
+        eq_(snt.Word("dog").rhyme_keys(), snt.Word("log").rhyme_keys())
+        eq_(snt.rhyme_key(["EH", "S"]), snt.rhyme_key(["IH", "Z"]))
+        ok_(not snt.Word("frog").rhyme_keys() & snt.Word("fraud").rhyme_keys())
+
+
+class TestWordCache(object):
+    def test_shared_analysis(self):
+        cache = snt.WordCache(maxsize=2)
+        a = cache.get("dog")
+        ok_(cache.get("dog") is a)
+        eq_((cache.hits, cache.misses), (1, 1))
+        eq_(a.syl_string, "x")
+        eq_(a.last_sounds, (("AO", "G"),))
+        assert_raises(AttributeError, setattr, a, "syl_string", "s")
+
+    def test_eviction(self):
+        cache = snt.WordCache(maxsize=2)
+        cache.get("dog")
+        cache.get("fire")
+        cache.get("dog")
+        cache.get("illusion")
+        eq_(len(cache), 2)
+        eq_(cache.evictions, 1)
+        ok_("fire" not in cache.records)
+        ok_("dog" in cache.records)
+
+    def test_words_share_analysis(self):
+        ok_(snt.Word("Fractal").analysis is snt.Word("fractal").analysis)
+
+
+class TestPhoneticIndex(object):
+    def setup(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".bin")
+        os.close(handle)
+        snt.PhoneticIndex.build(self.filename, {"dog": [["D", "AO1", "G"]],
+                                                "fire": [["F", "AY1", "ER0"], ["F", "AY1", "R"]],
+                                                "the": [["DH", "AH0"]],
+                                                u"caf\xe9": [[u"K", u"AE0", u"F", u"EY1"]],
+                                                "na\xc3\xafve": [["N", "AY0", "IY1", "V"]]})
+        self.index = snt.PhoneticIndex(self.filename)
+
+    def teardown(self):
+        os.remove(self.filename)
+
+    def test_entry(self):
+        eq_(len(self.index), 5)
+        ok_("dog" in self.index)
+        ok_("cat" not in self.index)
+
+        # Non-ASCII words, as unicode or as the UTF-8 bytes read from csv
+        ok_(u"caf\xe9" in self.index)
+        ok_("caf\xc3\xa9" in self.index)
+        ok_(u"na\xefve" in self.index)
+        ok_("r\xc3\xa9sum\xc3\xa9" not in self.index)
+        eq_(self.index.entry("caf\xc3\xa9")[1], ["us"])
+
+        prons, syl_strings, last_sounds = self.index.entry("fire")
+        eq_(prons, [["F", "AY1", "ER0"], ["F", "AY1", "R"]])
+        eq_(syl_strings, ["su", "x"])
+        eq_(last_sounds, [["AY", "ER"], ["AY", "R"]])
+
+        eq_(self.index.entry("the")[2], [None])
+
+    def test_lazy_dictionary(self):
+        d = snt.PhoneticDictionary(self.filename)
+        ok_(d.source is None)
+        eq_(d["dog"], [["D", "AO1", "G"]])
+        ok_(isinstance(d.source, snt.PhoneticIndex))
+
+        d["zorp"] = [["Z", "AO1", "R", "P"]]
+        ok_("zorp" in d)
+        eq_(d.entry("zorp")[1], ["x"])
+
+
+class TestMeter(object):
+    def test_patterns(self):
+        eq_(snt.iambic_pentameter.patterns, ("ususususus",))
+        loose = snt.loose_iambic_pentameter
+        eq_(set(loose.patterns), set(["ususususus", "suusususus", "ususususus" + "u", "suusususus" + "u"]))
+        eq_(loose.min_length, 10)
+
+    def test_matches(self):
+        ok_(snt.iambic_pentameter.matches("xxxxxxxxxx"))
+        ok_(not snt.iambic_pentameter.matches("usususus"))
+        ok_(not snt.iambic_pentameter.matches("sxususususu"))
+        ok_(snt.loose_iambic_pentameter.matches("sxususususu"))
+        ok_(snt.trochaic_tetrameter.matches("susxsusu"))
+
+    def test_line_scans(self):
+        a = snt.Line("Whose lips my lips have kissed, and how, and when")
+        ok_(a.scans())
+        ok_(a.scans(snt.loose_iambic_pentameter))
+        ok_(not a.scans(snt.iambic_tetrameter))
+
+        b = snt.Line("Tyger Tyger, burning bright")
+        ok_(b.too_short())
+        ok_(not b.too_short(snt.Meter("su", 3)))
+
+    def test_poem_meter(self):
+        eq_(snt.Sonnet().meter, snt.iambic_pentameter)
+        eq_(snt.HeroicCouplets(2, snt.iambic_tetrameter).meter, snt.iambic_tetrameter)
+
 
 class TestLine(object):
     def test_make_word_list(self):
@@ -122,6 +228,23 @@ class TestLine(object):
         eq_(len(d.word_list), 5)
         eq_(d.word_list[3].text, "he's")
 
+    def test_from_template(self):
+        a = snt.Template("He said, \"{} {}'s {}.\" {}", [snt.Blank("NN") for _ in xrange(4)])
+        for choices in [["the", "dog", "bone", "Then"], ["the", "dog", "bone", ""], ["the", "dog", "o'clock", "no"]]:
+            from_template = snt.Line.from_template(a, choices)
+            tokenized = snt.Line(a.raw_text.format(*choices))
+            eq_([word.text for word in from_template.word_list], [word.text for word in tokenized.word_list])
+            eq_(from_template.text, tokenized.text)
+            eq_(from_template.choices, choices)
+
+        # Text attached to a blank makes one word with the choice
+        for raw_text, choices, words in [("the {}s of day", ["dog"], ["the", "dogs", "of", "day"]),
+                                         ("un{} the day", ["do"], ["undo", "the", "day"]),
+                                         ("the {}-{} night", ["moon", "lit"], ["the", "moon-lit", "night"]),
+                                         ("the {}{} night", ["red ", "moon"], ["the", "red", "moon", "night"])]:
+            b = snt.Template(raw_text, [snt.Blank("NN", optional=choice.endswith(" ")) for choice in choices])
+            eq_([word.text for word in snt.Line.from_template(b, choices).word_list], words)
+
     def test_make_syl_strings(self):
         a = snt.Line("Whose lips my lips have kissed, and how, and when")
         a.make_syl_strings()
@@ -135,6 +258,22 @@ class TestLine(object):
         ok_("xsu" in b.syl_strings)
         ok_("susuu" in b.syl_strings)
 
+    def test_lazy_scans(self):
+        for text in ["Whose lips my lips have kissed, and how, and when",
+                     "our fire and every power of our every fire",
+                     "the radiant fire of every hour",
+                     "I hear the every dog"]:
+            lazy, listed = snt.Line(text), snt.Line(text)
+            listed.make_syl_strings()
+            eq_(lazy.scans(), listed.scans())
+            eq_(lazy.too_short(), listed.too_short())
+            ok_(lazy._syl_strings is None)
+
+        long_line = snt.Line(" ".join(["fire"] * 24))
+        ok_(not long_line.scans())
+        ok_(not long_line.too_short())
+        ok_(long_line._syl_strings is None)
+
     def test_scans(self):
         a = snt.Line("test")
         a.syl_strings = ["xxxxxxxxxx"]
@@ -204,6 +343,14 @@ class TestLine(object):
 
         ok_(a.same_choices(c))
 
+    def test_chosen_words(self):
+        a = snt.Line("test")
+        a.choices = ["red ", "dog", ""]
+        eq_(a.chosen_words(), ["red", "dog"])
+        ok_(a.no_repeated_choices())
+        a.choices = ["dog ", "dog", ""]
+        ok_(not a.no_repeated_choices())
+
     def test_a_to_an(self):
         a = snt.Line("Eve ate a apple")
         b = snt.Line("First sentence. A apple")
@@ -247,6 +394,77 @@ class TestTemplate(object):
 
         ok_(isinstance(a.populate(), snt.Line))
 
+    def test_tokens(self):
+        a = snt.Template("The {}'s {} of day,", [snt.Blank("NN"), snt.Blank("NN")])
+        eq_(a.tokens(), [(None, "The"), (0, "'s"), (1, ""), (None, "of"), (None, "day")])
+
+        b = snt.Template("the {}s of day", [snt.Blank("NN")])
+        eq_(b.tokens(), [(None, "the"), (0, "s"), (None, "of"), (None, "day")])
+        ok_(not b.compiled.attached)
+        c = snt.Template("the {}{} of day", [snt.Blank("JJ", optional=True), snt.Blank("NN")])
+        eq_(c.tokens(), [(None, "the"), (0, ""), (1, ""), (None, "of"), (None, "day")])
+        ok_(not c.compiled.attached)
+        for raw_text in ["un{} the day", "the {}-{} night"]:
+            ok_(snt.Template(raw_text, [snt.Blank("VB"), snt.Blank("NN")]).compiled.attached)
+
+    def test_compiled(self):
+        a = snt.CompiledTemplate("The {}'s {{brace}} {}", [False, True])
+        eq_(a.format(["dog", "red "]), "The dog's {brace} red ")
+        eq_((a.required_blanks, a.optional_blanks), ((0,), (1,)))
+        ok_(a.flexible)
+        ok_(not snt.CompiledTemplate("The {} of day", [False]).flexible)
+        eq_(a.fixed_variants[0], snt.Word("the").analysis.variants)
+        eq_(a.fixed_variants[1], None)
+        assert_raises(AttributeError, setattr, a, "flexible", False)
+        eq_(snt.CompiledTemplate("{0} and {1}", [False, False]).format(["a", "b"]), "a and b")
+
+    def test_stress_fits(self):
+        ok_(snt.stress_fits("su", 1))
+        ok_(not snt.stress_fits("su", 0))
+        ok_(snt.stress_fits("x", 0))
+        ok_(not snt.stress_fits("us", 9))
+
+    def test_seeded_line(self):
+        tags = ["NN", "VB", "NN"]
+        a = snt.Template("the {} will {} the {} of day,", [snt.Blank(tag) for tag in tags])
+        a.make_pools(vocab)
+
+        for guided in [True, False]:
+            texts = [a.make_scanning_line(guided=guided, rng=random.Random(2)).text for _ in xrange(2)]
+            eq_(texts[0], texts[1])
+
+    def test_guided_line(self):
+        tags = ["NN", "VB", "NN"]
+        a = snt.Template("the {} will {} the {} of day,", [snt.Blank(tag) for tag in tags])
+        a.make_pools(vocab)
+
+        for _ in xrange(5):
+            line = a.make_scanning_line()
+            ok_(line.scans())
+            ok_(line.no_repeated_choices())
+
+        b = snt.Template(" ".join(["{}"] * 12), [snt.Blank("NN") for _ in xrange(12)])
+        b.make_pools(vocab)
+        # Twelve words can't fit in ten syllables
+        assert_raises(snt.ScanFailure, b.make_scanning_line)
+
+        calls = []
+        a.guided_populate = lambda *args, **kwargs: calls.append(args)
+        assert_raises(snt.ScanFailure, a.make_scanning_line, attempts=7)
+        eq_(len(calls), 7)
+
+    def test_guided_optional(self):
+        blanks = [snt.Blank("JJ", optional=True), snt.Blank("NN"), snt.Blank("VB"), snt.Blank("NN")]
+        a = snt.Template("the {}{} will {} the {} of day,", blanks)
+        a.make_pools(vocab)
+
+        rng = random.Random(3)
+        lines = [a.make_scanning_line(rng=rng) for _ in xrange(30)]
+        ok_(all(line.scans() for line in lines))
+        # The line scans either way, so the adjective is sometimes left out
+        ok_(any(line.choices[0] for line in lines))
+        ok_(any(not line.choices[0] for line in lines))
+
     def test_template_reader(self):
         t = templates
         ok_(isinstance(t, list))
@@ -255,6 +473,22 @@ class TestTemplate(object):
         eq_(t[10].intro_required, "NP")
         eq_(t[10].intro, "VP")
 
+    def test_transition_index(self):
+        for t in templates:
+            eq_(templates.preceding(t), [template for template in templates
+                                         if t.intro_required and template.outro == t.intro_required])
+            eq_(templates.following(t), [template for template in templates
+                                         if t.outro_required and template.intro == t.outro_required])
+
+    def test_sentence_lengths(self):
+        catalog = templates.sentence_lengths(4)
+        for t in templates:
+            ok_(all(1 <= length <= 4 for length in catalog[t]))
+            if not t.intro_required and not t.outro_required:
+                eq_(catalog[t], frozenset([1]))
+            elif catalog[t]:
+                ok_(1 not in catalog[t])
+
     def test_flex(self):
         ok_(templates[0].is_flexible())
         ok_(not templates[23].is_flexible())
@@ -305,7 +539,7 @@ class TestSonnetWriter(object):
         eq_(sum([len(line_list) for line_list in self.sw.line_groups]), 14)
 
     def test_arrange_lines(self):
-        random.seed(1)
+        self.sw.seed(1)
         self.sw.pick_lines()
 
         self.sw.arrange_lines()
@@ -316,6 +550,63 @@ class TestSonnetWriter(object):
             eq_(sum([isinstance(temp, snt.Template) for temp in section.template_list]), 4)
         eq_(len(self.sw.current_poem.sections[-1].template_list), 2)
 
+    def test_pack_lengths(self):
+        eq_(snt.pack_lengths([3, 3, 3, 3, 2], [4, 4, 4, 2]), None)
+        placement = snt.pack_lengths([3, 1, 2, 2, 4, 2], [4, 4, 4, 2], rng=random.Random(0))
+        filled = [0, 0, 0, 0]
+        for length, index in zip([3, 1, 2, 2, 4, 2], placement):
+            filled[index] += length
+        eq_(filled, [4, 4, 4, 2])
+        ok_(snt.pack_lengths([3, 3], [4, 4], fits=lambda room: room <= 1) is not None)
+
+    def test_backtracking(self):
+        for seed in xrange(20):
+            self.sw.reset()
+            self.sw.seed(seed)
+            self.sw.pick_lines()
+            try:
+                self.sw.arrange_sections(self.sw.current_poem.sections)
+                break
+            except snt.ConstructionFailure:
+                pass
+        ok_(all(self.sw.matchable(section) for section in self.sw.current_poem.sections))
+        kept, dropped = self.sw.current_poem.sections[:2]
+        starts = [template.sentence_start for template in dropped.template_list]
+        for section, word in [(kept, "dog"), (dropped, "cat")]:
+            for template in section.template_list:
+                template.filled_line = snt.Line(word)
+                template.filled_line.choices = [word]
+                self.sw.vocab.use([word])
+            section.filled = True
+
+        self.sw.clear_section(dropped)
+        eq_(self.sw.vocab.used, set(["dog"]))
+        ok_(not dropped.filled)
+        ok_(all(template.filled_line is None for template in dropped.template_list))
+        eq_([template.sentence_start for template in dropped.template_list], starts)
+
+        kept_templates = list(kept.template_list)
+        unfilled = [t for section in self.sw.current_poem.unfilled_sections() for t in section.template_list]
+        self.sw.rearrange_unfilled()
+        eq_(kept.template_list, kept_templates)
+        eq_(sorted(unfilled), sorted(t for section in self.sw.current_poem.unfilled_sections()
+                                     for t in section.template_list))
+
+    def test_select_rhyming_candidates(self):
+        def line(text, choices):
+            made = snt.Line(text)
+            made.choices = choices
+            return made
+
+        a, b = snt.Template("", []), snt.Template("", [])
+        a.candidates = [line("the dog", ["dog"]), line("a cat", ["cat"]), line("the fire", ["fire"])]
+        b.candidates = [line("the log", ["log"]), line("my dog", ["dog"]), line("a hat", ["hat"]),
+                        line("my cat", ["my"]), line("the mess", ["mess"])]
+        pairs = self.sw.select_rhyming_candidates([a, b])
+        eq_([[one.text, two.text] for one, two in pairs], [["the dog", "the log"], ["a cat", "a hat"]])
+        eq_(pairs, [[one, two] for one in a.candidates for two in b.candidates
+                    if one.rhymes_with(two) and not one.same_choices(two)])
+
     def test_pick_hold_line(self):
         nonflex_t = templates[23]
         flex_t = templates[0]
@@ -342,6 +633,60 @@ class TestSonnetWriter(object):
         for t in tp:
             ok_(isinstance(t.filled_line, snt.Line))
 
+    def test_pick_rhymes_optional(self):
+        tp = [snt.Template(text, [snt.Blank("JJ", optional=True)] + [snt.Blank(tag) for tag in ["NN", "VB", "NN"]])
+              for text in ["and {}{} will {} beneath the {},", "the {}{} shall {} along the {}."]]
+        section = self.sw.current_poem.sections[-1]
+        section.template_list = tp
+        optional = False
+        for seed in xrange(10):
+            self.sw.seed(seed)
+            for t in tp:
+                t.make_pools(self.sw.vocab)
+            self.sw.pick_rhymes(tp)
+            optional = optional or any(t.filled_line.choices[0] for t in tp)
+            words = set(word for t in tp for word in t.filled_line.chosen_words())
+            # Optional choices keep a trailing space, the words used don't
+            eq_(words & self.sw.vocab.used, words)
+            ok_(not any(word.endswith(" ") for word in self.sw.vocab.used))
+            self.sw.clear_section(section)
+            eq_(words & self.sw.vocab.used, set())
+        ok_(optional)
+
+    def test_section_candidates(self):
+        tp = [snt.Template(text, [snt.Blank(tag) for tag in ["NN", "VB", "NN"]])
+              for text in ["and {} will {} beneath the {},", "the {} shall {} along the {}."]]
+        section = self.sw.current_poem.sections[-1]
+        section.template_list = tp
+        self.sw.seed(0)
+        self.sw.pick_rhymes(tp)
+        eq_(len(self.sw.section_candidates), 1)
+        (key, kept), = self.sw.section_candidates.items()
+        section_index, position, hold = key
+        eq_((section_index, position), (len(self.sw.current_poem.sections) - 1, tp.index(hold)))
+        ok_(hold.filled_line not in kept)
+
+        # Starting the section over keeps the hold line's candidates
+        self.sw.clear_section(section)
+        hold.make_pools(self.sw.vocab)
+        self.sw.make_hold_candidates(hold)
+        eq_(hold.candidates[:len(kept)], kept)
+        eq_(len(hold.candidates), 20)
+        eq_(self.sw.section_candidates, {})
+
+        self.sw.reset()
+        eq_(self.sw.section_candidates, {})
+
+    def test_seeded_writers_agree(self):
+        lines = []
+        for _ in xrange(2):
+            sw = snt.SonnetWriter(vocab, rng=random.Random(4))
+            sw.template_pool = templates
+            sw.current_poem = snt.Sonnet()
+            sw.pick_lines()
+            lines.append(sw.lines)
+        eq_(lines[0], lines[1])
+
     def test_set_coll_prob(self):
         self.sw.set_coll_prob(.6)
 
@@ -358,6 +703,65 @@ class TestSonnetWriter(object):
 
         ok_(templates[11] in self.sw.lines)
 
+class TestCandidateReservoir(object):
+    def setup(self):
+        self.template = snt.Template("the {} of {}", [snt.Blank("NN"), snt.Blank("NN")])
+        self.template.id = 0
+
+    def line(self, *choices):
+        return snt.Line.from_template(self.template, list(choices))
+
+    def test_take(self):
+        reservoir = snt.CandidateReservoir()
+        reservoir.put("key", [self.line("dog", "fire"), self.line("cat", "night")])
+        eq_(len(reservoir), 2)
+        lines = reservoir.take("key", 5, set(["dog"]))
+        eq_([line.choices for line in lines], [["cat", "night"]])
+        eq_(len(reservoir), 0)
+        stats = reservoir.stats()
+        eq_((stats["hits"], stats["misses"], stats["stale"]), (1, 4, 1))
+
+    def test_eviction(self):
+        reservoir = snt.CandidateReservoir(maxsize=2, max_offers=1)
+        reservoir.put("old", [self.line("dog", "fire")])
+        reservoir.put("new", [self.line("cat", "night"), self.line("owl", "moon")])
+        eq_(reservoir.stats()["evictions"], 1)
+        eq_(reservoir.take("old", 1, set()), [])
+        lines = reservoir.take("new", 1, set())
+        # Offered once already, so it isn't kept again
+        reservoir.put("new", lines)
+        eq_(len(reservoir), 1)
+
+    def test_writer_reuses_candidates(self):
+        sw = snt.SonnetWriter(vocab, reservoir=snt.CandidateReservoir())
+        sw.template_pool = templates
+        sw.current_poem = snt.HeroicCouplets(1)
+        vocab.clear_used()
+        template = templates[0]
+        template.make_pools(vocab)
+        sw.make_hold_candidates(template)
+        template.filled_line = template.candidates[0]
+        sw.recycle_candidates(template)
+        eq_(len(sw.reservoir), 19)
+        sw.make_hold_candidates(template)
+        eq_(sw.reservoir.stats()["hits"], 19)
+        template.cleanup()
+
+    def test_refill_stops(self):
+        sw = snt.SonnetWriter(vocab, reservoir=snt.CandidateReservoir())
+        sw.template_pool = templates[:1]
+        sw.current_poem = snt.HeroicCouplets(1)
+        vocab.clear_used()
+        ok_(sw.refill_reservoir(depth=5, target=10))
+        ok_(sw.refill_reservoir(depth=5, target=10))
+        eq_(len(sw.reservoir), 10)
+        # Every template has its target, so there's nothing to do
+        ok_(not sw.refill_reservoir(depth=5, target=10))
+        sw.reservoir = snt.CandidateReservoir(maxsize=4)
+        ok_(not sw.refill_reservoir(depth=5, target=10))
+        templates[0].cleanup()
+
+
 class TestCollectionReader(object):
     def __init__(self):
         self.filename = "autumn_collection.csv"
@@ -375,6 +779,12 @@ class TestCollections(object):
         vocab.add_collection("autumn")
         ok_("November" in vocab.collection_pool["NN"])
 
+    def test_similarity_index(self):
+        collection = vocab.collections["autumn"]
+        index = snt.SimilarityIndex.build({"autumn": collection})
+        for synset in snt.wn.synsets("dog") + snt.wn.synsets("run"):
+            eq_(index.max_similarities(synset, 3)["autumn"], collection.max_similarities(synset, 3))
+
 
 class TestCollectionManager(object):
     def setup(self):
@@ -394,6 +804,35 @@ class TestVocab(object):
         ok_("class" in rhymes)
         ok_("glass" in rhymes)
 
+        source = snt.Word("mass")
+        scanned = [word for word in vocab.uncommon_words("NN") if source.rhymes_with(snt.Word(word))]
+        eq_(rhymes, scanned)
+
+    def test_snapshot(self):
+        handle, filename = tempfile.mkstemp(suffix=".pickle")
+        os.close(handle)
+        small = snt.Vocab(common_depth=50, uncommon_depth=200)
+        small.save_snapshot(filename)
+
+        loaded = snt.Vocab.from_snapshot(filename, common_depth=50, uncommon_depth=200, rebuild=False)
+        ok_(loaded.complete)
+        eq_(loaded.common_words("NN"), small.common_words("NN"))
+        eq_(loaded.uncommon_words("VB"), small.uncommon_words("VB"))
+        eq_(loaded.common_words("not-a-tag"), [])
+
+        stale = snt.Vocab.from_snapshot(filename, common_depth=60, uncommon_depth=200, rebuild=False)
+        ok_(not stale.complete)
+        ok_(not os.path.exists("{}.{}.tmp".format(filename, os.getpid())))
+
+        # A snapshot cut off part way through counts as stale
+        with open(filename, "rb") as f:
+            data = f.read()
+        for junk in [data[:len(data) // 2], "", "not a pickle"]:
+            with open(filename, "wb") as f:
+                f.write(junk)
+            ok_(not small.load_snapshot(filename))
+        os.remove(filename)
+
     def test_not_used(self):
         vocab.add_collection("autumn")
 
@@ -401,12 +840,57 @@ class TestVocab(object):
 
         ok_("amber" in pool)
 
-        vocab.used.append("amber")
+        vocab.use(["amber"])
+        ok_("amber" not in pool)
         pool = vocab.make_collection_pool("JJ")
 
         ok_("amber" not in pool)
         ok_("hungry" in pool)
 
+        vocab.release(["amber"])
+        ok_("amber" in vocab.make_collection_pool("JJ"))
+
+    def test_release(self):
+        small = snt.Vocab(common_depth=50, uncommon_depth=200)
+        word = small.common_words("NN")[0]
+        small.use([word])
+        # Made while the word is in use, so it's left out until it's released
+        nouns = small.make_common_pool("NN")
+        noun_stresses = small.stress_pool("common", "NN")
+        verbs = small.make_common_pool("VB")
+        verb_stresses = small.stress_pool("common", "VB")
+        ok_(word not in nouns)
+
+        small.release([word])
+        ok_(word not in small.used)
+        eq_(nouns, small.common_words("NN"))
+        # Rebuilt in place, so blanks holding the pools see the word again
+        ok_(small.make_common_pool("NN") is nouns)
+        ok_(small.stress_pool("common", "NN") is noun_stresses)
+        ok_(any(word in bucket for bucket in noun_stresses.values()))
+        ok_(small.make_common_pool("VB") is verbs)
+        ok_(small.stress_pool("common", "VB") is verb_stresses)
+
+        small.use([word])
+        ok_(word not in nouns)
+        small.release([word])
+        ok_(word in nouns)
+
+    def test_stress_pools(self):
+        trochees = vocab.find_words("NN", pattern="su")
+        ok_(trochees)
+        ok_(all("su" in snt.analyze(word.lower()).variants for word in trochees))
+        monosyllables = vocab.find_words("NN", syllables=1)
+        ok_(monosyllables)
+        ok_(all(1 in map(len, snt.analyze(word.lower()).variants) for word in monosyllables))
+
+        word = trochees[0]
+        vocab.use([word])
+        ok_(word not in vocab.find_words("NN", pattern="su"))
+        ok_(word not in vocab.make_common_pool("NN"))
+        vocab.release([word])
+        ok_(word in vocab.find_words("NN", pattern="su"))
+
 
 class Test_Prompter(object):
     def setup(self):
@@ -443,4 +927,41 @@ class Test_Prompter(object):
         match = self.p.pick_collection()
 
         ok_(isinstance(match, snt.Collection))
-        eq_(match_id, "music")
\ No newline at end of file
+        eq_(match_id, "music")
+
+
+class TestPoemRecords(object):
+    def setup(self):
+        self.template = snt.Template("the {} will {} the {} of day,", [snt.Blank(tag) for tag in ["NN", "VB", "NN"]])
+        self.template.id = 7
+        self.couplets = snt.HeroicCouplets(1)
+        section = self.couplets.sections[0]
+        section.template_list = [self.template, self.template]
+        self.template.filled_line = self.template.make_line(["sun", "paint", "close"])
+        self.couplets.make_text()
+        section.human = 5
+        handle, self.filename = tempfile.mkstemp(suffix=".jsonl")
+        os.close(handle)
+
+    def teardown(self):
+        os.remove(self.filename)
+
+    def test_round_trip(self):
+        with snt.PoemWriter(self.filename) as output:
+            output.write(self.couplets)
+            output.write(self.couplets)
+        with open(self.filename, "a") as f:
+            f.write('{"form": "HeroicCoup')
+            # A record cut off by a crash
+
+        poems = list(snt.read_poems(self.filename))
+        eq_(len(poems), 2)
+        poem = poems[0]
+        ok_(isinstance(poem, snt.HeroicCouplets))
+        eq_(poem.text, self.couplets.text)
+        section = poem.sections[0]
+        eq_(section.human, 5)
+        eq_(section.interesting, None)
+        eq_(section.template_list[0].id, 7)
+        eq_(section.template_list[0].raw_text, self.template.raw_text)
+        eq_(section.lines[0].choices, ["sun", "paint", "close"])